@@ -10,15 +10,26 @@ import threading
 import queue
 import argparse
 import subprocess
+import shutil
+import io
+import tarfile
+import zipfile
+import struct
+import signal
+import select
+import json
+import functools
 import cv2
-import skvideo.io
 import numpy as np
-from gpiozero import LED
-from picamera import PiCamera
-from picamera.array import PiRGBArray
+try:
+    from gpiozero import LED
+    from picamera import PiCamera
+    from picamera.array import PiRGBArray
+except ImportError: # allows offline tools to import this module on a machine without a Pi
+    LED = PiCamera = PiRGBArray = None
 
 #global variables for cv2.setMouseCallback
-cordinates = np.zeros((3, 4), dtype=np.int)
+cordinates = np.zeros((3, 4), dtype=int)
 mode = 0
 draw = False
 
@@ -73,18 +84,1142 @@ def in_box(x, y, box):
     xmin, xmax, ymin, ymax = box
     return bool(x >= xmin and x <= xmax and y >= ymin and y <= ymax)
 
+def draw_zone(mask, zone, origin=(0, 0)):
+    '''fill a zone on mask with 1. zones are dicts in camera cordinates:
+       {'shape': 'box', 'box': [x1, y1, x2, y2]} (edges included, as in_box),
+       {'shape': 'polygon', 'points': [[x, y], ...]} or
+       {'shape': 'ellipse', 'center': [x, y], 'axes': [a, b], 'angle': degrees}.
+       origin (x, y) is subtracted from the cordinates'''
+    ox, oy = origin
+    if zone['shape'] == 'box':
+        x1, y1, x2, y2 = zone['box']
+        xmin, xmax = sorted([x1 - ox, x2 - ox])
+        ymin, ymax = sorted([y1 - oy, y2 - oy])
+        mask[max(0, ymin):max(0, ymax + 1), max(0, xmin):max(0, xmax + 1)] = 1
+    elif zone['shape'] == 'polygon':
+        points = np.array(zone['points'], dtype=np.int32) - np.array([ox, oy], dtype=np.int32)
+        cv2.fillPoly(mask, [points], 1)
+    elif zone['shape'] == 'ellipse':
+        cx, cy = zone['center']
+        a, b = zone['axes']
+        cv2.ellipse(mask, (int(round(cx - ox)), int(round(cy - oy))), (int(round(a)), int(round(b)))
+                    , zone.get('angle', 0), 0, 360, 1, -1)
+    else:
+        raise ValueError('unknown zone shape: {}'.format(zone['shape']))
+
+class ZoneMap(object):
+    '''zones rasterized once into a label image in box0 cordinates.
+       label 0 is outside of all zones and label i the i-th zone; where zones overlap
+       the later one wins. a position is looked up with one array index.
+       margin: the zones are also kept enlarged by this many px for the exit hysteresis'''
+    def __init__(self, shape, zones, origin=(0, 0), margin=0):
+        self.labels = np.zeros(shape, dtype=np.uint8)
+        self.margin = margin
+        self.enlarged = [None] # enlarged[i]: mask of zone i grown by margin
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * margin + 1, 2 * margin + 1))
+        for i, zone in enumerate(zones, 1):
+            mask = np.zeros(shape, dtype=np.uint8)
+            draw_zone(mask, zone, origin)
+            self.labels[mask > 0] = i
+            if margin > 0:
+                mask = cv2.dilate(mask, kernel)
+            self.enlarged.append(mask > 0)
+        self.height, self.width = shape
+
+    def __len__(self):
+        return len(self.enlarged) - 1
+
+    def zone(self, x, y):
+        '''return the zone id at (x, y), 0 outside of zones and of the field'''
+        x, y = int(x), int(y)
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return int(self.labels[y, x])
+        return 0
+
+    def in_zone(self, x, y, zoneid, enlarged=False):
+        '''return True if (x, y) is in zone zoneid, or in the zone grown by margin'''
+        if not enlarged:
+            return self.zone(x, y) == zoneid
+        x, y = int(x), int(y)
+        return bool(0 <= x < self.width and 0 <= y < self.height and self.enlarged[zoneid][y, x])
+
+    def center(self, zoneid):
+        '''return the (x, y) centroid of the pixels labelled zoneid, or None'''
+        ys, xs = np.nonzero(self.labels == zoneid)
+        if len(xs) == 0:
+            return None
+        return xs.mean(), ys.mean()
+
+    def lookup(self, x, y, valid=None):
+        '''zone ids for whole trajectories. x and y are arrays in box0 cordinates, NaN or
+           rows where valid is False give -1 (not detected), positions off the field 0'''
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        zones = np.full(x.shape, -1, dtype=np.int8)
+        ok = np.isfinite(x) & np.isfinite(y)
+        if valid is not None:
+            ok &= np.asarray(valid, dtype=bool)
+        zones[ok] = 0
+        xi = np.floor(np.where(ok, x, -1)).astype(np.int64)
+        yi = np.floor(np.where(ok, y, -1)).astype(np.int64)
+        inside = ok & (xi >= 0) & (xi < self.width) & (yi >= 0) & (yi < self.height)
+        zones[inside] = self.labels[yi[inside], xi[inside]]
+        return zones
+
 def outline_text(im, text, location, font, size, color, thikness):
     '''place text with white outline'''
     cv2.putText(im, text, location, font, size, (255, 255, 255), thikness*2, lineType=cv2.LINE_AA)
     cv2.putText(im, text, location, font, size, color, thikness, lineType=cv2.LINE_AA)
 
 
-def compress(q,image):
-    ''' compress the image and put it to the queue'''
-    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 50] 
-    result, encimg = cv2.imencode('.jpg', image, encode_param)
-    q.put(encimg)
-    q.task_done()
+def largest_component(binary_image, border=False):
+    '''return (centroid, area) of the largest non-zero component, or (None, 0).
+       with border=True, a component touching the image edge is rejected
+       because it may continue outside of the searched image'''
+    n, labels, stats, centroids = cv2.connectedComponentsWithStats(binary_image, connectivity=8)
+    if n < 2: # label 0 is the background
+        return None, 0
+    i = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    if border:
+        left, top = stats[i, cv2.CC_STAT_LEFT], stats[i, cv2.CC_STAT_TOP]
+        right = left + stats[i, cv2.CC_STAT_WIDTH]
+        bottom = top + stats[i, cv2.CC_STAT_HEIGHT]
+        height, width = binary_image.shape
+        if left == 0 or top == 0 or right == width or bottom == height:
+            return None, 0
+    return centroids[i], stats[i, cv2.CC_STAT_AREA]
+
+def find_blob(grayimage, threshold, border=False):
+    '''return the centroid of the largest component below threshold, or None'''
+    retVal, binary_image = cv2.threshold(grayimage, threshold, 255, cv2.THRESH_BINARY_INV)
+    return largest_component(binary_image, border)[0]
+
+THRESHOLD_SCORE_DTYPE = np.dtype([('threshold', '<i2'), ('detection', '<f4'), ('areacv', '<f4')
+                                  , ('jitter', '<f4'), ('score', '<f4')])
+
+def threshold_scores(grayframes, thresholds, minarea=20, maxfraction=0.1, scale=0.5):
+    '''score binarization thresholds for find_blob on a buffer of gray frames (n, h, w).
+       the downscaled frames are stacked into one image with a bright row between them,
+       so each threshold takes one connected-component pass over the whole buffer.
+       detection: fraction of frames whose largest dark blob has minarea to maxfraction
+       of the frame. areacv: variation (std / mean) of its area. jitter: median change of
+       its velocity between frames in px, small for a smoothly moving animal.
+       score = detection / ((1 + areacv) * (1 + jitter / 5)).
+       return a THRESHOLD_SCORE_DTYPE array'''
+    small = np.stack([cv2.resize(f, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) for f in grayframes])
+    n, h, w = small.shape
+    stack = np.full((n, h + 1, w), 255, dtype=np.uint8)
+    stack[:, :h] = small
+    stack = stack.reshape(n * (h + 1), w)
+    maxarea = maxfraction * h * w / scale ** 2
+    scores = np.zeros(len(thresholds), dtype=THRESHOLD_SCORE_DTYPE)
+    for i, threshold in enumerate(thresholds):
+        retVal, binary = cv2.threshold(stack, int(threshold), 255, cv2.THRESH_BINARY_INV)
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=8)
+        stats, centroids = stats[1:], centroids[1:] # label 0 is the background
+        frame = stats[:, cv2.CC_STAT_TOP] // (h + 1)
+        area = stats[:, cv2.CC_STAT_AREA]
+        # the largest component of each frame is the last one after sorting by frame and area
+        order = np.lexsort((area, frame))
+        largest = order[np.r_[frame[order][1:] != frame[order][:-1], True]] if len(order) else order
+        blobarea = np.zeros(n)
+        blobarea[frame[largest]] = area[largest] / scale ** 2
+        centers = np.full((n, 2), np.nan)
+        centers[frame[largest], 0] = centroids[largest, 0] / scale
+        centers[frame[largest], 1] = (centroids[largest, 1] - frame[largest] * (h + 1)) / scale
+        detected = (blobarea >= minarea) & (blobarea <= maxarea)
+        centers[~detected] = np.nan
+        detection = detected.mean()
+        areas = blobarea[detected]
+        areacv = areas.std() / areas.mean() if len(areas) > 1 else np.nan
+        change = np.hypot(*(centers[2:] - 2 * centers[1:-1] + centers[:-2]).T)
+        jitter = np.median(change[np.isfinite(change)]) if np.isfinite(change).any() else np.nan
+        score = detection / ((1 + np.nan_to_num(areacv)) * (1 + np.nan_to_num(jitter) / 5))
+        scores[i] = (threshold, detection, areacv, jitter, score)
+    return scores
+
+class EncoderPool(object):
+    '''fixed pool of long-lived JPEG encoder threads.
+       frames are submitted without blocking; if the queue is full the frame is dropped.
+       encoded frames are handed to sink(tag, encimg) in submission order; a frame that
+       fails to encode is counted in failed and handed to failure(tag) instead, if given'''
+    def __init__(self, sink, workers=2, maxsize=8, quality=50, failure=None):
+        self.sink = sink
+        self.failure = failure
+        self.encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+        self.jobs = queue.Queue(maxsize=maxsize)
+        self.results = {}
+        self.lock = threading.Lock()
+        self.nextseq = 0 # sequence number of the next submitted frame
+        self.outseq = 0 # sequence number of the next frame handed to sink
+        self.dropped = 0
+        self.failed = 0
+        self.encoded = 0
+        self.encodetime = 0.0
+        self.maxencodetime = 0.0
+        self.workers = [threading.Thread(target=self._encode, daemon=True) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _encode(self):
+        '''worker loop: encode frames until a None job arrives'''
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            seq, tag, image, encode = job
+            s = time.perf_counter()
+            try:
+                if isinstance(image, CapturedFrame): # color conversion is left to the encoder threads
+                    image = image.color()
+                if encode is None:
+                    result, encimg = cv2.imencode('.jpg', image, self.encode_param)
+                else:
+                    encimg = encode(image, self.encode_param)
+            except Exception as e:
+                # the seq is still filled, with None, so that drain() moves past it
+                encimg = None
+                with self.lock:
+                    self.failed += 1
+                    if self.failed == 1:
+                        sys.stderr.write('encoding failed for frame {}: {!r}\n'.format(tag, e))
+            elapsed = time.perf_counter() - s
+            with self.lock:
+                self.results[seq] = (tag, encimg)
+                self.encoded += 1
+                self.encodetime += elapsed
+                self.maxencodetime = max(self.maxencodetime, elapsed)
+
+    def submit(self, image, tag, encode=None):
+        '''queue a copy of image (an array or a CapturedFrame) for encoding as JPEG, or with
+           encode(image, encode_param) in the encoder thread. return False if the frame was dropped'''
+        if self.jobs.full():
+            self.dropped += 1
+            return False
+        self.jobs.put_nowait((self.nextseq, tag, image.copy(), encode))
+        self.nextseq += 1
+        return True
+
+    def drain(self):
+        '''hand encoded frames to sink in order, up to the first unfinished one'''
+        while True:
+            with self.lock:
+                item = self.results.pop(self.outseq, None)
+            if item is None:
+                return
+            if item[1] is not None:
+                self.sink(*item)
+            elif self.failure is not None:
+                self.failure(item[0])
+            self.outseq += 1
+
+    def close(self):
+        '''wait for queued frames, stop the workers and flush the rest to sink'''
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.drain()
+
+# one record per tracked frame, see RPP.process_frame. zone is the ZoneMap label at
+# the position (0: no zone), or -1 when the animal was not detected. px, py and pzone
+# are the position the laser decision used (predicted with --predict) and its zone
+LOCATION_DTYPE = np.dtype([('period', '<i2'), ('x', '<i4'), ('y', '<i4'), ('zone', '<i1')
+                           , ('stimulation', '<i1'), ('time', '<f8')
+                           , ('px', '<i4'), ('py', '<i4'), ('pzone', '<i1')])
+
+class LocationLog(object):
+    '''append-only binary location log of LOCATION_DTYPE records.
+       records are flushed every flushevery frames so little is lost if the session dies'''
+    def __init__(self, path, flushevery=100):
+        self.path = path
+        self.outf = open(path, 'wb')
+        self.flushevery = flushevery
+        self.count = 0
+        self.record = np.zeros(1, dtype=LOCATION_DTYPE)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, period, x, y, zone, stimulation, time, px, py, pzone):
+        self.record[0] = (period, x, y, zone, stimulation, time, px, py, pzone)
+        self.outf.write(self.record.tobytes())
+        self.count += 1
+        if self.count % self.flushevery == 0:
+            self.outf.flush()
+
+    def close(self):
+        if not self.outf.closed:
+            self.outf.close()
+
+def load_location(path):
+    '''return the records of a location log (location.bin) as a read-only memory-mapped
+       structured array; fields such as data['x'] are views without copy.
+       a partly written last record of an interrupted session is ignored'''
+    count = os.path.getsize(path) // LOCATION_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=LOCATION_DTYPE)
+    return np.memmap(path, dtype=LOCATION_DTYPE, mode='r', shape=(count,))
+
+def write_location_text(data, path):
+    '''export location records as location.txt in the format of earlier versions.
+       in_box1 is derived from the zone id; zone and the decision position follow as new columns'''
+    outf = open(path, 'w')
+    outf.write('\t'.join(['period', 'x', 'y', 'in_box1', 'stimulation', 'time', 'zone', 'px', 'py', 'pzone'])+'\n')
+    for period, x, y, zone, stimulation, t, px, py, pzone in data.tolist():
+        in_box1 = 'nan' if zone < 0 else str(zone == 1)
+        outf.write('\t'.join([str(period), str(x), str(y), in_box1, str(stimulation), str(t)]
+                             + [str(v) for v in (zone, px, py, pzone)])+'\n')
+    outf.close()
+
+TIMING_STAGES = ['capture', 'waitkey', 'submit', 'convert', 'search', 'decision', 'draw', 'display', 'drain']
+
+class StageTimer(object):
+    '''per-frame stage durations of the tracking loop, written to a tab separated file.
+       mark(stage) adds the time since the previous mark to that stage, so the time
+       waiting for the next frame is counted as capture'''
+    def __init__(self, path, flushevery=100):
+        self.outf = open(path, 'w')
+        self.outf.write('\t'.join(['frame', 'time', 'interval'] + TIMING_STAGES) + '\n')
+        self.flushevery = flushevery
+        self.frames = 0
+        self.durations = dict.fromkeys(TIMING_STAGES, 0.0)
+        self.totals = dict.fromkeys(TIMING_STAGES, 0.0)
+        self.maxima = dict.fromkeys(TIMING_STAGES, 0.0)
+        self.firsttime = None
+        self.frametime = None
+        self.interval = np.nan
+        self.last = time.perf_counter()
+
+    def start(self, frametime):
+        '''start a frame that arrived at frametime(session time)'''
+        self.mark('capture')
+        if self.frametime is None:
+            self.firsttime = frametime
+        else:
+            self.interval = frametime - self.frametime
+        self.frametime = frametime
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.durations[stage] += now - self.last
+        self.last = now
+
+    def end(self):
+        '''finish the frame and write its row. times in the file are in s, durations in ms'''
+        self.mark('drain')
+        self.outf.write('\t'.join([str(self.frames), '{:.6f}'.format(self.frametime), '{:.6f}'.format(self.interval)]
+                                  + ['{:.3f}'.format(1000 * self.durations[stage]) for stage in TIMING_STAGES]) + '\n')
+        for stage in TIMING_STAGES:
+            self.totals[stage] += self.durations[stage]
+            self.maxima[stage] = max(self.maxima[stage], self.durations[stage])
+            self.durations[stage] = 0.0
+        self.frames += 1
+        if self.frames % self.flushevery == 0:
+            self.outf.flush()
+
+    def summary(self):
+        '''return log lines with the achieved frame rate and mean/max duration of each stage'''
+        if self.frames < 2:
+            return []
+        lines = ['timing: achieved frame rate {:.2f} fps\n'.format(
+            (self.frames - 1) / (self.frametime - self.firsttime))]
+        for stage in TIMING_STAGES:
+            lines.append('timing {}: mean {:.2f} ms, max {:.2f} ms\n'.format(
+                stage, 1000 * self.totals[stage] / self.frames, 1000 * self.maxima[stage]))
+        return lines
+
+    def close(self):
+        self.outf.close()
+
+class NullTimer(object):
+    '''stands in for StageTimer when timing is disabled'''
+    def start(self, frametime):
+        pass
+
+    def mark(self, stage):
+        pass
+
+    def end(self):
+        pass
+
+class SimulatedCamera(object):
+    '''stands in for PiCamera where frames come from elsewhere: keeps the settings RPP writes to it'''
+    def __init__(self):
+        self.resolution = (704, 350)
+        self.brightness = 70
+        self.contrast = 100
+        self.framerate = 10
+
+    def close(self):
+        pass
+
+def to_gray(image):
+    '''return a gray image of a BGR image, or the image if it is gray already'''
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+class CapturedFrame(object):
+    '''a frame in the ring of a frame source. gray is the luminance plane, a view into
+       the ring slot; the BGR image is made from the slot only when color() is called.
+       time is the arrival time of the frame'''
+    def __init__(self, slot, togray, tocolor, time):
+        self.slot = slot
+        self.togray = togray
+        self.tocolor = tocolor
+        self.time = time
+        self.gray = togray(slot)
+        self.colorimage = None
+
+    def color(self):
+        if self.colorimage is None:
+            self.colorimage = self.tocolor(self.slot)
+        return self.colorimage
+
+    def copy(self):
+        '''return a frame with its own copy of the slot, which the source will reuse'''
+        return CapturedFrame(self.slot.copy(), self.togray, self.tocolor, self.time)
+
+class FrameSource(object):
+    '''interface of frame sources: frames() yields CapturedFrame objects from a ring of
+       nslots preallocated buffers. a yielded frame stays valid until the next one is
+       taken; frames that arrive meanwhile may be dropped (counted in dropped, for the
+       last frames() call)'''
+    def __init__(self, nslots=4):
+        self.nslots = nslots
+        self.dropped = 0
+
+    def frames(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+def yuv_gray(slot, width, height):
+    '''the Y plane of a padded YUV420 frame, a view into slot'''
+    return slot[:height, :width]
+
+def yuv_color(slot, width, height):
+    '''the BGR image of a padded YUV420 frame'''
+    return cv2.cvtColor(slot, cv2.COLOR_YUV2BGR_I420)[:height, :width]
+
+class PiCameraSource(FrameSource):
+    '''records unencoded YUV420 from the video port of a PiCamera into the ring.
+       tracking reads the Y plane in place; the color image is converted from YUV on demand'''
+    def __init__(self, camera, nslots=4):
+        FrameSource.__init__(self, nslots)
+        self.camera = camera
+        self.width, self.height = camera.resolution
+        # the camera pads rows to 32 and the planes to 16 rows
+        padwidth, padheight = (self.width + 31) // 32 * 32, (self.height + 15) // 16 * 16
+        self.ring = [np.empty((padheight * 3 // 2, padwidth), dtype=np.uint8) for i in range(nslots)]
+        self.framesize = self.ring[0].size
+        self.times = [0.0] * nslots
+        self.written = 0 # frames written into the ring
+        self.taken = 0 # frames handed out by frames()
+        self.inuse = None # slot of the frame handed out last
+        self.cond = threading.Condition()
+
+    def write(self, buf):
+        '''picamera output, called with one complete frame per call for unencoded formats'''
+        slot = self.written % self.nslots
+        if len(buf) != self.framesize or slot == self.inuse:
+            self.dropped += 1
+            return len(buf)
+        self.ring[slot].reshape(-1)[:] = np.frombuffer(buf, dtype=np.uint8)
+        with self.cond:
+            self.times[slot] = time.time()
+            self.written += 1
+            self.cond.notify()
+        return len(buf)
+
+    def flush(self):
+        pass
+
+    def gray(self, slot):
+        return yuv_gray(slot, self.width, self.height)
+
+    def color(self, slot):
+        return yuv_color(slot, self.width, self.height)
+
+    def frames(self):
+        '''start recording and yield the newest frame each time one arrives'''
+        # frames of an earlier call (set_camera, habituation) are neither yielded nor counted
+        with self.cond:
+            self.written = 0
+            self.taken = 0
+            self.inuse = None
+            self.dropped = 0
+        self.camera.start_recording(self, format='yuv')
+        try:
+            while True:
+                with self.cond:
+                    while self.written == self.taken:
+                        self.cond.wait()
+                    self.dropped += self.written - self.taken - 1 # frames that arrived meanwhile
+                    self.taken = self.written
+                    self.inuse = (self.taken - 1) % self.nslots
+                yield CapturedFrame(self.ring[self.inuse], self.gray, self.color, self.times[self.inuse])
+        finally:
+            self.camera.stop_recording()
+
+class VideoCaptureSource(FrameSource):
+    '''frames from cv2.VideoCapture (a video file or a webcam by device number), read
+       into the ring. with a camera, its resolution and frame rate are requested'''
+    def __init__(self, device=0, camera=None, nslots=4):
+        FrameSource.__init__(self, nslots)
+        self.cap = cv2.VideoCapture(device)
+        if not self.cap.isOpened():
+            raise IOError('cannot open video source {}'.format(device))
+        if camera is not None:
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera.resolution[0])
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera.resolution[1])
+            self.cap.set(cv2.CAP_PROP_FPS, camera.framerate)
+        self.ring = None
+
+    def frames(self):
+        '''yield frames until the video ends'''
+        i = 0
+        while True:
+            slot = i % self.nslots
+            if self.ring is None: # the frame size is known from the first frame
+                ret, image = self.cap.read()
+                if ret:
+                    self.ring = [np.empty_like(image) for j in range(self.nslots)]
+                    self.ring[slot][:] = image
+                    image = self.ring[slot]
+            else:
+                ret, image = self.cap.read(self.ring[slot])
+            if not ret:
+                return
+            # a copy, so drawing on the color image leaves the ring slot to preview and encoder
+            yield CapturedFrame(image, to_gray, lambda slot: slot.copy(), time.time())
+            i += 1
+
+    def close(self):
+        self.cap.release()
+
+class SyntheticSource(FrameSource):
+    '''renders a dark disk moving through the frame on a bright, noisy background at the
+       frame rate of the camera. frames are rendered as luminance only'''
+    def __init__(self, camera, nslots=4, realtime=True):
+        FrameSource.__init__(self, nslots)
+        self.width, self.height = camera.resolution
+        self.framerate = float(camera.framerate)
+        self.realtime = realtime
+        rng = np.random.default_rng(0)
+        self.background = rng.integers(170, 230, (self.height, self.width), dtype=np.uint8)
+        self.ring = [np.empty((self.height, self.width), dtype=np.uint8) for i in range(nslots)]
+        self.radius = max(5, self.height // 30)
+
+    def render(self, slot, t):
+        '''draw the frame at time t (s) into slot; the disk follows a Lissajous path'''
+        r = self.radius
+        x = int(r + (self.width - 2 * r) * (0.5 + 0.5 * np.sin(0.7 * t)))
+        y = int(r + (self.height - 2 * r) * (0.5 + 0.5 * np.sin(1.1 * t)))
+        slot[:] = self.background
+        cv2.circle(slot, (x, y), r, 10, -1)
+
+    def frames(self):
+        '''yield frames forever, paced to the frame rate if realtime'''
+        start = time.time()
+        i = 0
+        while True:
+            if self.realtime:
+                time.sleep(max(0, start + i / self.framerate - time.time()))
+            slot = self.ring[i % self.nslots]
+            self.render(slot, i / self.framerate)
+            yield CapturedFrame(slot, lambda slot: slot, lambda slot: cv2.cvtColor(slot, cv2.COLOR_GRAY2BGR)
+                                , time.time())
+            i += 1
+
+def open_source(spec, camera):
+    '''return the frame source for a --source option: picamera, synthetic,
+       or a video file or device number for cv2.VideoCapture'''
+    if spec == 'picamera':
+        return PiCameraSource(camera)
+    elif spec == 'synthetic':
+        return SyntheticSource(camera)
+    return VideoCaptureSource(int(spec) if spec.isdigit() else spec, camera)
+
+class PositionPredictor(object):
+    '''constant-velocity Kalman filter on tracked positions (state x, y, vx, vy).
+       update(t, position) corrects the track with a position found at session time t
+       (None if not detected); predict(t) returns where the animal is expected at t.
+       the track survives maxmisses frames without detection and is dropped after that.
+       processnoise: acceleration noise density (px^2/s^3), measurementnoise: variance of
+       a detected position (px^2)'''
+    def __init__(self, processnoise=1e5, measurementnoise=4.0, maxmisses=1):
+        self.processnoise = processnoise
+        self.measurement = measurementnoise * np.eye(2)
+        self.maxmisses = maxmisses
+        self.observe = np.array([[1., 0, 0, 0], [0, 1., 0, 0]])
+        self.state = None
+        self.cov = None
+        self.time = None
+        self.misses = 0
+
+    def propagate(self, t):
+        '''return state and covariance of the track moved forward to time t'''
+        dt = t - self.time
+        transition = np.eye(4)
+        transition[0, 2] = transition[1, 3] = dt
+        q = self.processnoise
+        noise = np.zeros((4, 4))
+        noise[0, 0] = noise[1, 1] = q * dt ** 3 / 3
+        noise[0, 2] = noise[2, 0] = noise[1, 3] = noise[3, 1] = q * dt ** 2 / 2
+        noise[2, 2] = noise[3, 3] = q * dt
+        return transition.dot(self.state), transition.dot(self.cov).dot(transition.T) + noise
+
+    def update(self, t, position):
+        if position is None:
+            self.misses += 1
+            if self.misses > self.maxmisses:
+                self.state = None
+            return
+        z = np.array(position, dtype=np.float64)
+        self.misses = 0
+        if self.state is None: # a new track starts at rest with unknown velocity
+            self.state = np.array([z[0], z[1], 0., 0.])
+            self.cov = np.diag([self.measurement[0, 0], self.measurement[1, 1], 1e4, 1e4])
+        else:
+            state, cov = self.propagate(t)
+            H = self.observe
+            gain = cov.dot(H.T).dot(np.linalg.inv(H.dot(cov).dot(H.T) + self.measurement))
+            self.state = state + gain.dot(z - H.dot(state))
+            self.cov = (np.eye(4) - gain.dot(H)).dot(cov)
+        self.time = t
+
+    def predict(self, t):
+        '''return the (x, y) expected at time t, or None without a track'''
+        if self.state is None:
+            return None
+        state, cov = self.propagate(t)
+        return state[0], state[1]
+
+class StimulationScheduler(object):
+    '''turns zone updates from the tracker into laser stimulation.
+       stimulation starts once the animal has stayed mindwell s in the zone and stops when
+       it leaves the zone enlarged by the hysteresis margin (see ZoneMap). with threaded=True one long-lived thread
+       pulses the trigger (ontime on, offtime off) on a fixed time grid and logs each rising
+       edge (session time) to edgepath as float64. with threaded=False the trigger is only
+       switched with the stimulation state, which is what offline replay needs'''
+    def __init__(self, trigger, ontime, offtime, mindwell=0, edgepath=None, threaded=True):
+        self.trigger = trigger
+        self.ontime = ontime
+        self.pulseperiod = ontime + offtime
+        self.mindwell = mindwell
+        self.active = False
+        self.entered = None # session time the animal entered the zone
+        self.starttime = time.time() # origin of logged edge times
+        self.pulses = 0
+        self.edgefile = open(edgepath, 'wb') if edgepath else None
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = None
+        if threaded:
+            self.thread = threading.Thread(target=self._pulse, daemon=True)
+            self.thread.start()
+
+    def update(self, now, inzone, inmargin):
+        '''take whether the animal is in the zone to stimulate at session time now, and
+           whether it is in that zone enlarged by the hysteresis margin (both False when not
+           detected or outside sessions). return True while stimulating'''
+        if self.active:
+            inzone = inmargin
+        if inzone:
+            if self.entered is None:
+                self.entered = now
+            active = self.active or now - self.entered >= self.mindwell
+        else:
+            self.entered = None
+            active = False
+        if active != self.active:
+            if self.thread is not None:
+                with self.cond:
+                    self.active = active
+                    self.cond.notify()
+            else:
+                self.active = active
+                if active:
+                    self.trigger.on()
+                    self._log_edge(now)
+                else:
+                    self.trigger.off()
+        return active
+
+    def _log_edge(self, t):
+        self.pulses += 1
+        if self.edgefile is not None:
+            self.edgefile.write(struct.pack('<d', t))
+            if self.pulses % 50 == 0:
+                self.edgefile.flush()
+
+    def _pulse(self):
+        '''pulse thread: one pulse per period while active'''
+        nextedge = 0.0
+        while True:
+            with self.cond:
+                while not self.stopped:
+                    if not self.active:
+                        self.cond.wait()
+                    elif nextedge > time.time():
+                        self.cond.wait(nextedge - time.time())
+                    else:
+                        break
+                if self.stopped:
+                    break
+            edge = time.time()
+            self.trigger.on()
+            self._log_edge(edge - self.starttime)
+            time.sleep(max(0, edge + self.ontime - time.time()))
+            self.trigger.off()
+            # stay on the grid of the running pulse train, start a new one after a pause
+            if edge - nextedge > self.pulseperiod:
+                nextedge = edge
+            nextedge += self.pulseperiod
+
+    def close(self):
+        '''stop stimulation and the pulse thread'''
+        if self.thread is not None:
+            with self.cond:
+                self.stopped = True
+                self.cond.notify()
+            self.thread.join()
+            self.thread = None
+        self.active = False
+        self.trigger.off()
+        if self.edgefile is not None:
+            self.edgefile.close()
+            self.edgefile = None
+
+def load_pulses(path):
+    '''return the session times of the stimulation rising edges saved in pulses.bin'''
+    return np.fromfile(path, dtype='<f8')
+
+class ControlChannel(object):
+    '''non-blocking operator control for headless mode.
+       a line "q" on stdin or SIGINT/SIGTERM asks to quit, a line "s" or SIGUSR1 asks for status'''
+    def __init__(self):
+        self.requests = []
+        self.handlers = {}
+        for signum, command in [(signal.SIGINT, 'q'), (signal.SIGTERM, 'q'), (signal.SIGUSR1, 's')]:
+            self.handlers[signum] = signal.signal(signum, lambda n, f, c=command: self.requests.append(c))
+
+    def poll(self):
+        '''return the next command ('q' or 's'), or None without waiting'''
+        if not self.requests and select.select([sys.stdin], [], [], 0)[0]:
+            line = sys.stdin.readline().strip()
+            if line in ('q', 's'):
+                self.requests.append(line)
+        if self.requests:
+            return self.requests.pop(0)
+        return None
+
+    def close(self):
+        '''restore the previous signal handlers'''
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+
+class Preview(object):
+    '''shows the latest frame, downsampled, at a low rate from its own thread.
+       update() only replaces the shared slot, so the tracking loop never waits for display'''
+    def __init__(self, rate=2, scale=0.5, title='live'):
+        self.rate = rate
+        self.scale = scale
+        self.title = title
+        self.latest = None
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._show, daemon=True)
+        self.thread.start()
+
+    def update(self, image):
+        self.latest = image
+
+    def _show(self):
+        while not self.stop.wait(1 / self.rate):
+            image = self.latest
+            if image is None:
+                continue
+            cv2.imshow(self.title, cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA))
+            cv2.waitKey(1)
+        cv2.destroyWindow(self.title)
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+# one index record per stored frame; the record size is fixed so a store
+# left by a crashed session can still be read up to the last full record.
+# kind is one of FRAME_FULL, FRAME_CROP and FRAME_TILES
+FRAMEINDEX_DTYPE = np.dtype([('frame', '<i4'), ('chunk', '<i4'), ('offset', '<i8')
+                             , ('size', '<i4'), ('time', '<f8'), ('period', '<i2'), ('kind', '<u1')])
+
+class FrameStore(object):
+    '''append-only store of encoded frames, written by a background thread.
+       frames are concatenated into chunk files (chunk_0000.mjpg, ...) and indexed
+       in index.bin with FRAMEINDEX_DTYPE records. meta (e.g. the recording mode)
+       is saved in recording.json'''
+    def __init__(self, path, chunksize=256 * 2**20, flushevery=50, meta=None):
+        self.path = path
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+        if meta is not None:
+            outf = open(os.path.join(self.path, 'recording.json'), 'w')
+            json.dump(meta, outf)
+            outf.close()
+        self.chunksize = chunksize
+        self.flushevery = flushevery
+        self.chunk = -1
+        self.chunkfile = None
+        self.offset = 0
+        self.count = 0
+        self.indexfile = open(os.path.join(self.path, 'index.bin'), 'wb')
+        self.jobs = queue.Queue()
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def append(self, data, frameno, timestamp, period, kind=0):
+        '''queue an encoded frame for writing'''
+        self.jobs.put((data, frameno, timestamp, period, kind))
+
+    def _next_chunk(self):
+        if self.chunkfile is not None:
+            self.chunkfile.close()
+        self.chunk += 1
+        self.offset = 0
+        self.chunkfile = open(os.path.join(self.path, 'chunk_{:04d}.mjpg'.format(self.chunk)), 'wb')
+
+    def _write(self):
+        '''writer loop: append frames until a None job arrives'''
+        record = np.zeros(1, dtype=FRAMEINDEX_DTYPE)
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            data, frameno, timestamp, period, kind = job
+            data = memoryview(data).cast('B')
+            if self.chunkfile is None or self.offset + len(data) > self.chunksize:
+                self._next_chunk()
+            self.chunkfile.write(data)
+            record[0] = (frameno, self.chunk, self.offset, len(data), timestamp, period, kind)
+            self.indexfile.write(record.tobytes())
+            self.offset += len(data)
+            self.count += 1
+            if self.count % self.flushevery == 0:
+                self.chunkfile.flush()
+                self.indexfile.flush()
+
+    def close(self):
+        '''write the remaining frames and close the files'''
+        self.jobs.put(None)
+        self.writer.join()
+        if self.chunkfile is not None:
+            self.chunkfile.close()
+        self.indexfile.close()
+
+class FrameStoreReader(object):
+    '''random access to the frames of a FrameStore directory.
+       index is a structured array with FRAMEINDEX_DTYPE fields, meta the saved recording.json'''
+    def __init__(self, path):
+        self.path = path
+        metapath = os.path.join(self.path, 'recording.json')
+        self.meta = json.load(open(metapath)) if os.path.exists(metapath) else {}
+        raw = open(os.path.join(self.path, 'index.bin'), 'rb').read()
+        nrecord = len(raw) // FRAMEINDEX_DTYPE.itemsize
+        self.index = np.frombuffer(raw[:nrecord * FRAMEINDEX_DTYPE.itemsize], dtype=FRAMEINDEX_DTYPE)
+        self.chunkfiles = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def read(self, i):
+        '''return the encoded bytes of the i-th stored frame'''
+        record = self.index[i]
+        chunk = int(record['chunk'])
+        if chunk not in self.chunkfiles:
+            chunkpath = os.path.join(self.path, 'chunk_{:04d}.mjpg'.format(chunk))
+            self.chunkfiles[chunk] = open(chunkpath, 'rb')
+        f = self.chunkfiles[chunk]
+        f.seek(int(record['offset']))
+        return f.read(int(record['size']))
+
+    def __iter__(self):
+        '''yield (index record, encoded bytes) in recording order'''
+        for i in range(len(self)):
+            yield self.index[i], self.read(i)
+
+    def close(self):
+        for f in self.chunkfiles.values():
+            f.close()
+        self.chunkfiles = {}
+
+# kinds of stored frames: the full camera frame, the box0 crop, or the tiles of the
+# box0 crop that changed since the last full frame (keyframe)
+FRAME_FULL, FRAME_CROP, FRAME_TILES = 0, 1, 2
+RECORD_MODES = ['full', 'crop', 'tiles']
+TILE_COLUMNS = 64 # tiles per row of the JPEG holding the changed tiles
+
+def encode_crop(image, encode_param, box0):
+    '''encode the box0 crop of a full frame as JPEG'''
+    result, encimg = cv2.imencode('.jpg', image[box0[2]:box0[3], box0[0]:box0[1]], encode_param)
+    return encimg
+
+def encode_tiles(image, encode_param, box0, reference, tilesize=32, tolerance=4):
+    '''encode the tiles of the box0 crop whose mean absolute gray level difference from
+       reference (the gray crop of the keyframe) exceeds tolerance: a uint32 count, the
+       uint32 tile numbers (row-major) and one JPEG of the tiles, TILE_COLUMNS per row'''
+    crop = image[box0[2]:box0[3], box0[0]:box0[1]]
+    t = tilesize
+    height, width = crop.shape[:2]
+    ny, nx = -(-height // t), -(-width // t)
+    diff = np.zeros((ny * t, nx * t), dtype=np.float32)
+    diff[:height, :width] = cv2.absdiff(to_gray(crop), reference)
+    tiles = np.flatnonzero(diff.reshape(ny, t, nx, t).mean(axis=(1, 3)) > tolerance).astype('<u4')
+    header = np.frombuffer(struct.pack('<I', len(tiles)) + tiles.tobytes(), dtype=np.uint8)
+    if len(tiles) == 0:
+        return header
+    padded = np.zeros((ny * t, nx * t, 3), dtype=np.uint8)
+    padded[:height, :width] = crop
+    columns = min(len(tiles), TILE_COLUMNS)
+    rows = -(-len(tiles) // columns)
+    blocks = np.zeros((rows * columns, t, t, 3), dtype=np.uint8)
+    blocks[:len(tiles)] = padded.reshape(ny, t, nx, t, 3).swapaxes(1, 2).reshape(ny * nx, t, t, 3)[tiles]
+    mosaic = blocks.reshape(rows, columns, t, t, 3).swapaxes(1, 2).reshape(rows * t, columns * t, 3)
+    result, encimg = cv2.imencode('.jpg', mosaic, encode_param)
+    return np.concatenate([header, encimg.reshape(-1)])
+
+def paste_tiles(crop, data, tilesize=32):
+    '''paste the tiles encoded by encode_tiles onto crop'''
+    t = tilesize
+    n = struct.unpack_from('<I', data)[0]
+    if n == 0:
+        return
+    tiles = np.frombuffer(data, dtype='<u4', count=n, offset=4)
+    mosaic = cv2.imdecode(np.frombuffer(data, dtype=np.uint8, offset=4 + 4 * n), 1)
+    height, width = crop.shape[:2]
+    nx = -(-width // t)
+    columns = mosaic.shape[1] // t
+    for j, tile in enumerate(tiles.tolist()):
+        y0, x0 = divmod(tile, nx)
+        y0, x0 = y0 * t, x0 * t
+        my, mx = divmod(j, columns)
+        h, w = min(t, height - y0), min(t, width - x0)
+        crop[y0:y0 + h, x0:x0 + w] = mosaic[my * t:my * t + h, mx * t:mx * t + w]
+
+class RecordingReader(object):
+    '''rebuilds full BGR frames from a FrameStore of any recording mode. crops and
+       tiles are pasted on the last keyframe before them, or on a black frame'''
+    def __init__(self, path):
+        self.frames = FrameStoreReader(path)
+        self.index = self.frames.index
+        self.meta = self.frames.meta
+        self.keyframes = np.flatnonzero(self.index['kind'] == FRAME_FULL)
+        self.cached = (None, None) # (position, image) of the last decoded keyframe
+
+    def __len__(self):
+        return len(self.index)
+
+    def keyframe(self, i):
+        '''return the decoded keyframe at or before stored frame i'''
+        k = np.searchsorted(self.keyframes, i, side='right') - 1
+        if k < 0:
+            width, height = self.meta['resolution']
+            return np.zeros((height, width, 3), dtype=np.uint8)
+        k = int(self.keyframes[k])
+        if self.cached[0] != k:
+            self.cached = (k, cv2.imdecode(np.frombuffer(self.frames.read(k), dtype=np.uint8), 1))
+        return self.cached[1]
+
+    def read(self, i):
+        '''return the i-th stored frame as a full BGR image'''
+        image = self.keyframe(i).copy()
+        kind = self.index[i]['kind']
+        if kind == FRAME_FULL:
+            return image
+        xmin, xmax, ymin, ymax = self.meta['box0']
+        data = self.frames.read(i)
+        if kind == FRAME_CROP:
+            crop = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), 1)
+            image[ymin:ymin + crop.shape[0], xmin:xmin + crop.shape[1]] = crop
+        else:
+            paste_tiles(image[ymin:ymax, xmin:xmax], data, self.meta.get('tilesize', 32))
+        return image
+
+    def __iter__(self):
+        '''yield (index record, BGR image) in recording order'''
+        for i in range(len(self)):
+            yield self.index[i], self.read(i)
+
+    def close(self):
+        self.frames.close()
+
+def show_progress(i, n):
+    '''write progress in percent every 10 items'''
+    if i % 10 == 0:
+        sys.stdout.write('\rprogress: {:3.2f} %'.format(100 * i / n))
+
+ARCHIVE_MODES = {'tar': ('images.tar', 'w'), 'targz': ('images.tar.gz', 'w:gz'), 'zip': ('images.zip', None)}
+
+def write_archive(frames, archivepath, arcdir, fmt='tar', extrafiles=(), progress=None):
+    '''write the frames of a FrameStoreReader into a tar or zip archive in one pass.
+       members are named arcdir/N.jpg with N the frame number, as in the images directory.
+       extrafiles are added under arcdir with their base name'''
+    mtime = time.time()
+    if fmt == 'zip':
+        archive = zipfile.ZipFile(archivepath, 'w', zipfile.ZIP_STORED)
+        date_time = time.localtime(mtime)[:6]
+        def add(name, data):
+            archive.writestr(zipfile.ZipInfo(name, date_time), data)
+    else:
+        archive = tarfile.open(archivepath, ARCHIVE_MODES[fmt][1])
+        def add(name, data):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime
+            archive.addfile(info, io.BytesIO(data))
+    for path in extrafiles:
+        with open(path, 'rb') as f:
+            add(os.path.join(arcdir, os.path.basename(path)), f.read())
+    for i, (record, encimg) in enumerate(frames):
+        add(os.path.join(arcdir, '{}.jpg'.format(record['frame'])), encimg)
+        if progress is not None:
+            progress(i, len(frames))
+    archive.close()
+
+AVI_MAX_SIZE = 2**32 - 1 # sizes and offsets in an AVI 1.0 file are 32 bit
+AVI_HEADER_SIZE = 212 # RIFF and hdrl lists written by write_mjpeg_avi before the movi list
+
+def video_slots(frames, framerate):
+    '''return the frame slot of each frame of a FrameStoreReader by its recorded time'''
+    times = frames.index['time']
+    if not len(times):
+        return []
+    return [int(round(t)) for t in ((times - times[0]) * framerate).tolist()]
+
+def mjpeg_avi_size(frames, framerate):
+    '''return the size in bytes of the file write_mjpeg_avi writes for frames'''
+    entries = 0
+    for slot in video_slots(frames, framerate):
+        entries = max(entries, slot) + 1
+    sizes = frames.index['size'].astype(np.int64)
+    data = int(np.sum(8 + sizes + sizes % 2)) + 8 * (entries - len(sizes))
+    return AVI_HEADER_SIZE + 12 + data + 8 + 16 * entries
+
+def write_timestamps(videopath, timestamps):
+    '''write frame times(s) next to a video, in timestamp format v2 of mkvmerge: one time in ms per frame'''
+    timestamppath = os.path.splitext(videopath)[0] + '_timestamps.txt'
+    outf = open(timestamppath, 'w')
+    outf.write('# timestamp format v2\n')
+    for t in timestamps:
+        outf.write('{:.3f}\n'.format(1000 * t))
+    outf.close()
+
+def write_mjpeg_avi(frames, videopath, framerate, progress=None):
+    '''mux the JPEG frames of a FrameStoreReader into an MJPEG AVI without re-encoding.
+       each frame is placed at the slot given by its recorded time; slots without a
+       frame (dropped or late frames) get an empty chunk, which players show as a
+       repeat of the previous frame. exact times are written to a timestamp file.
+       raises ValueError before writing if the file would exceed AVI_MAX_SIZE'''
+    size = mjpeg_avi_size(frames, framerate)
+    if size > AVI_MAX_SIZE:
+        raise ValueError('{} frames need {:.1f} GB as AVI, more than the 4 GB an AVI file can hold'.format(
+            len(frames), size / 2**30))
+    scale = 1000
+    rate = int(round(framerate * scale))
+    if len(frames):
+        height, width = cv2.imdecode(np.frombuffer(frames.read(0), dtype=np.uint8), 0).shape
+    else:
+        width, height = 0, 0
+    outf = open(videopath, 'wb')
+    # headers are written with placeholder counts and patched at the end
+    outf.write(b'RIFF\0\0\0\0AVI LIST' + struct.pack('<I', 4 + 64 + 12 + 64 + 48) + b'hdrl')
+    outf.write(b'avih' + struct.pack('<I', 56))
+    avihpos = outf.tell()
+    outf.write(struct.pack('<14I', int(1e6 * scale / rate), 0, 0, 0x10, 0, 0, 1, 0, width, height, 0, 0, 0, 0))
+    outf.write(b'LIST' + struct.pack('<I', 4 + 64 + 48) + b'strl')
+    outf.write(b'strh' + struct.pack('<I', 56))
+    strhpos = outf.tell()
+    outf.write(b'vidsMJPG' + struct.pack('<IHHIIIIIIiI4h', 0, 0, 0, 0, scale, rate, 0, 0, 0, -1, 0
+                                        , 0, 0, width, height))
+    outf.write(b'strf' + struct.pack('<I', 40))
+    outf.write(struct.pack('<IiiHH', 40, width, height, 1, 24) + b'MJPG'
+               + struct.pack('<IiiII', width * height * 3, 0, 0, 0, 0))
+    moviepos = outf.tell()
+    outf.write(b'LIST\0\0\0\0movi')
+    index = []
+    timestamps = []
+    maxsize = 0
+    starttime = frames.index['time'][0] if len(frames) else 0
+    for i, (record, encimg) in enumerate(frames):
+        slot = int(round((record['time'] - starttime) * framerate))
+        while len(index) < slot: # no frame for this slot
+            index.append((outf.tell() - moviepos - 8, 0, 0))
+            outf.write(b'00dc\0\0\0\0')
+        index.append((outf.tell() - moviepos - 8, 0x10, len(encimg)))
+        outf.write(b'00dc' + struct.pack('<I', len(encimg)))
+        outf.write(encimg)
+        if len(encimg) % 2:
+            outf.write(b'\0')
+        maxsize = max(maxsize, len(encimg))
+        timestamps.append(record['time'] - starttime)
+        if progress is not None:
+            progress(i, len(frames))
+    moviend = outf.tell()
+    outf.write(b'idx1' + struct.pack('<I', 16 * len(index)))
+    for offset, flags, size in index:
+        outf.write(b'00dc' + struct.pack('<III', flags, offset, size))
+    fileend = outf.tell()
+    outf.seek(4)
+    outf.write(struct.pack('<I', fileend - 8))
+    outf.seek(avihpos + 4)
+    outf.write(struct.pack('<I', int(maxsize * framerate)))
+    outf.seek(avihpos + 16)
+    outf.write(struct.pack('<I', len(index)))
+    outf.seek(avihpos + 28)
+    outf.write(struct.pack('<I', maxsize))
+    outf.seek(strhpos + 32)
+    outf.write(struct.pack('<II', len(index), maxsize))
+    outf.seek(moviepos + 4)
+    outf.write(struct.pack('<I', moviend - moviepos - 8))
+    outf.close()
+    write_timestamps(videopath, timestamps)
+
+def write_ffmpeg_video(frames, videopath, framerate, progress=None):
+    '''encode the JPEG frames of a FrameStoreReader to H.264 with ffmpeg, for sessions too
+       long for write_mjpeg_avi. slots without a frame repeat the previous frame, so the
+       video keeps the recorded timing. exact times are written to a timestamp file'''
+    command = ['ffmpeg', '-loglevel', 'error', '-y', '-f', 'image2pipe', '-framerate', str(framerate)
+               , '-c:v', 'mjpeg', '-i', '-', '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', videopath]
+    p = subprocess.Popen(command, stdin=subprocess.PIPE)
+    timestamps = []
+    written = 0
+    previous = None
+    starttime = frames.index['time'][0] if len(frames) else 0
+    for i, ((record, encimg), slot) in enumerate(zip(frames, video_slots(frames, framerate))):
+        if previous is None: # nothing to repeat before the first frame
+            written = slot
+        while written < slot: # no frame for this slot
+            p.stdin.write(previous)
+            written += 1
+        p.stdin.write(encimg)
+        written += 1
+        previous = encimg
+        timestamps.append(record['time'] - starttime)
+        if progress is not None:
+            progress(i, len(frames))
+    p.stdin.close()
+    if p.wait() != 0:
+        raise IOError('ffmpeg failed to write {}'.format(videopath))
+    write_timestamps(videopath, timestamps)
+
+def start_transcode(videopath, outputpath):
+    '''convert a video to H.264 with ffmpeg in a detached, low priority process.
+       the process outlives this script, so the rig can be used right away'''
+    command = ['nice', '-n', '19', 'ffmpeg', '-loglevel', 'error', '-y', '-i', videopath
+               , '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', outputpath]
+    return subprocess.Popen(command, stdin=subprocess.DEVNULL, start_new_session=True)
 
 class RPP(object):
     '''Conditioned place preference test'''
@@ -92,14 +1227,37 @@ class RPP(object):
         '''initializing RPP object'''
         self.animalID = animalID
         self.dir = keywords.get('dir', './')
-        self.camera = PiCamera()
+        self.camera = keywords.get('camera')
+        self.owncamera = self.camera is None # a camera passed in is closed by its owner
+        if self.camera is None:
+            self.camera = PiCamera()
         self.camera.resolution = keywords.get('resolution', (704, 350))
-        self.camera.brightness = 70
-        self.camera.contrast = 100
+        self.camera.brightness = keywords.get('brightness', 70)
+        self.camera.contrast = keywords.get('contrast', 100)
         self.camera.framerate = keywords.get('framerate', 10)
+        self.framerate = float(self.camera.framerate)
+        self.source = keywords.get('source', 'picamera') # FrameSource or a --source option
         self.pulselength = keywords.get('pulselength', 10)
         self.frequency = keywords.get('frequency', 20)
         self.threshold = keywords.get('threshold', 30)
+        self.searchwindow = keywords.get('searchwindow', 80)
+        self.calibrate = keywords.get('calibrate', 3) # s of frames for the threshold calibration
+        self.annotate = keywords.get('annotate', True) # draw position and status on tracked frames
+        self.tracker = keywords.get('tracker', 'threshold')
+        self.scale = keywords.get('scale', 0.5)
+        self.difference = keywords.get('difference', 25)
+        self.minarea = keywords.get('minarea', 20)
+        self.learningrate = keywords.get('learningrate', 0.01)
+        self.backgroundsamples = []
+        self.background = None
+        self.lastcenter = None # last detected position, used for the search window
+        self.zones = keywords.get('zones') # zone dicts (see draw_zone), default: box1 and box2
+        self.hysteresis = keywords.get('hysteresis', 0)
+        self.predict = keywords.get('predict') # s ahead of the frame to predict the position for, None: off
+        self.predictor = None
+        if self.predict is not None:
+            self.predictor = PositionPredictor(keywords.get('processnoise', 1e5), keywords.get('measurementnoise', 4.0)
+                                               , keywords.get('maxmisses', 1))
         self.adaptation = keywords.get('adaptation', 20)
         self.pre_session = keywords.get('pre_session', 10)
         self.breaktime = keywords.get('breaktime', 0)
@@ -109,20 +1267,44 @@ class RPP(object):
             self.firstbox = 'left'
         self.pin = keywords.get('pin', 14)
         self.savevideo = keywords.get('savevideo', False)
+        self.transcode = keywords.get('transcode', False)
+        self.encoders = keywords.get('encoders', 2)
+        self.encodequeue = keywords.get('encodequeue', 8)
+        self.lateframes = 0
+        self.timing = keywords.get('timing', False)
+        self.timer = NullTimer()
+        self.headless = keywords.get('headless', False)
+        self.previewrate = keywords.get('previewrate', 0)
+        self.previewscale = keywords.get('previewscale', 0.5)
+        self.preview = None
+        self.control = None # ControlChannel during habituation and tracking in headless mode
         self.sessionlength = sessionlength
         self.noalternate = noalternate
-        self.framelist = []
-        self.locationlist = []
+        self.keepframes = keywords.get('keepframes', False)
+        self.record = keywords.get('record', 'full') # one of RECORD_MODES
+        self.keyframe = keywords.get('keyframe') # s between full frames
+        if self.keyframe is None:
+            self.keyframe = 10 if self.record == 'tiles' else 0
+        self.tilesize = keywords.get('tilesize', 32)
+        self.tiletolerance = keywords.get('tiletolerance', 4)
+        self.lastkeyframe = None # session time of the last submitted keyframe
+        self.reference = None # gray box0 crop of the last stored keyframe for the tiles mode
+        self.pendingreference = None # (frame number, gray box0 crop) of a keyframe being encoded
+        self.archive = keywords.get('archive', 'tar')
+        self.savetext = keywords.get('savetext', True)
         self.ontime = min(0.001 * self.pulselength, 0.5 / self.frequency)
         self.offtime = 1/self.frequency - self.ontime
-        self.dirpath = os.path.join(self.dir, '-'.join([self.animalID, datetime.datetime.now().strftime('%Y%m%d%H%M')]))
+        self.dirpath = keywords.get('dirpath'
+                                    , os.path.join(self.dir, '-'.join([self.animalID, datetime.datetime.now().strftime('%Y%m%d%H%M')])))
         self.logpath = os.path.join(self.dirpath, 'log.txt')
         if not os.path.exists(self.dirpath):
             os.mkdir(self.dirpath)
+        self.framestorepath = os.path.join(self.dirpath, 'frames')
         self.imagedirpath = os.path.join(self.dirpath, 'images')
         if not os.path.exists(self.imagedirpath):
             os.mkdir(self.imagedirpath)
         self.log = open(self.logpath, 'w')
+        self.location = LocationLog(os.path.join(self.dirpath, 'location.bin'))
         self.laser_switch_settings = [0, 1, 0, 2]
         # 0: laser off, 1: laser on in box1, 2: laser on in box2
         self.period = 0
@@ -134,8 +1316,14 @@ class RPP(object):
             self.times = [first_session_start, break_start]
         else:
             self.times = [first_session_start, break_start, second_session_start, second_session_end]
-        self.trigger = LED(self.pin)
+        self.trigger = keywords.get('trigger')
+        if self.trigger is None:
+            self.trigger = LED(self.pin)
         self.trigger.off()
+        self.stimulator = StimulationScheduler(self.trigger, self.ontime, self.offtime, keywords.get('mindwell', 0)
+                                               , os.path.join(self.dirpath, 'pulses.bin')
+                                               , threaded=keywords.get('stimthread', keywords.get('trigger') is None))
+        self.current_time = 0 # session time of the frame being tracked
 
     def initial_log(self):
         '''record info before start a recording sesion'''
@@ -157,6 +1345,17 @@ class RPP(object):
         else:
             self.record_log('\n')
         self.record_log('stimulation frequency: {} Hz\n'.format(self.frequency))
+        self.record_log('stimulation hysteresis: {} px, minimum dwell: {} s\n'.format(
+            self.hysteresis, self.stimulator.mindwell))
+        self.record_log('search window: {} px\n'.format(self.searchwindow))
+        if self.predictor is not None:
+            self.record_log('prediction: lead {} s, bridged misses {}\n'.format(self.predict, self.predictor.maxmisses))
+        if self.record != 'full':
+            self.record_log('recording: {}, keyframe every {} s, tile {} px, tolerance {}\n'.format(
+                self.record, self.keyframe, self.tilesize, self.tiletolerance))
+        if self.tracker != 'threshold':
+            self.record_log('tracker: {}, scale {}, difference {}, minimum area {} px\n'.format(
+                self.tracker, self.scale, self.difference, self.minarea))
 
     def record_log(self, text):
         '''write text in log and stdout'''
@@ -165,13 +1364,21 @@ class RPP(object):
 
     def set_camera(self):
         ''' setting camera condition before session'''
-        cap = PiRGBArray(self.camera, size=self.camera.resolution)
         cv2.namedWindow('camera setting')
-        for frame in self.camera.capture_continuous(cap, format='bgr', use_video_port=True):
-            image = frame.array
+        calibration = None # gray frames buffered for the threshold calibration
+        frames = self.frame_source().frames()
+        for frame in frames:
+            image = frame.color().copy()
             key = cv2.waitKey(1)&0xFF
+            if calibration is not None:
+                calibration.append(frame.gray.copy())
+                if len(calibration) >= self.calibrate * self.framerate:
+                    self.calibrate_threshold(calibration)
+                    calibration = None
             if key == ord('o'):
                 break
+            elif key == ord('a') and calibration is None:
+                calibration = []
             elif key == ord('c'):
                 self.camera.contrast = max(0, self.camera.contrast - 1)
             elif key == ord('C'):
@@ -185,19 +1392,39 @@ class RPP(object):
             elif key == ord('T'):
                 self.threshold = min(255, self.threshold + 1)
             try:
-                x, y = self.get_center(image)
+                x, y = self.get_center_threshold(frame.gray)
+                cv2.circle(image, (x,y), 5, (255,255,255), -1)
             except:
                 pass
             outline_text(image, 'Set camera condition. "c"/"C" for contrast, "b"/"B" for brightness'
                         , (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
-            outline_text(image, '"t"/"T" for binarization threshold, "o" for OK'
+            outline_text(image, '"t"/"T" for binarization threshold ({}), "a" for automatic, "o" for OK'.format(self.threshold)
                         , (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
             outline_text(image, 'TURN LASER ON NOW', (10, 90), cv2.FONT_HERSHEY_SIMPLEX
                          , 0.5, (0, 0, 0), 1)
+            if calibration is not None:
+                outline_text(image, 'calibrating threshold, keep the animal in view', (10, 120)
+                             , cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
             cv2.imshow('camera setting', image)
-            cap.truncate(0)
+        frames.close()
         self.originalimg = copy.copy(image)
         cv2.destroyAllWindows()
+        self.record_log('binarization threshold: {}\n'.format(self.threshold))
+
+    def calibrate_threshold(self, grayframes):
+        '''set the binarization threshold that scores best on buffered gray frames
+           (see threshold_scores) and record the scores of all thresholds in the log'''
+        scores = threshold_scores(grayframes, np.arange(4, 160, 2), self.minarea)
+        self.record_log('threshold calibration on {} frames (threshold, detection rate, area variation'
+                        ', centroid jitter px, score):\n'.format(len(grayframes)))
+        for s in scores:
+            self.record_log('  {}\t{:.3f}\t{:.3f}\t{:.2f}\t{:.3f}\n'.format(*s.tolist()))
+        best = scores[np.argmax(scores['score'])]
+        if best['score'] > 0:
+            self.threshold = int(best['threshold'])
+            self.record_log('proposed threshold: {}\n'.format(self.threshold))
+        else:
+            self.record_log('no threshold found the animal, threshold unchanged\n')
 
     def sort_cordinate(self, box):
         ''' sort [x1, y1, x2, y2] cordinates to  [minx, maxx, miny, maxy]'''
@@ -243,9 +1470,14 @@ class RPP(object):
         cv2.imwrite(boximagepath, img, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
         time.sleep(1)
         cv2.destroyAllWindows()
+        self.set_boxes(box_0, box_1, box_2)
+
+    def set_boxes(self, box_0, box_1, box_2):
+        '''set the field (box_0) and the two boxes from [x1, y1, x2, y2] cordinates'''
         self.record_log('box0: ({}, {}) x ({}, {})\n'.format(*box_0))
         self.record_log('box1: ({}, {}) x ({}, {})\n'.format(*box_1))
         self.record_log('box2: ({}, {}) x ({}, {})\n'.format(*box_2))
+        self.rawboxes = [list(box_0), list(box_1), list(box_2)]
         self.box0 = self.sort_cordinate(box_0)
         box1 = self.sort_cordinate(box_1)
         box2 = self.sort_cordinate(box_2)
@@ -263,15 +1495,41 @@ class RPP(object):
                 self.boxorder = [self.box2, self.box1]
         self.record_log('adjusted box1 cordinates :({0}, {2}) x ({1}, {3})\n'.format(*self.box1))
         self.record_log('adjusted box2 cordinates :({0}, {2}) x ({1}, {3})\n'.format(*self.box2))
+        zones = self.zones or [{'shape': 'box', 'box': box_1}, {'shape': 'box', 'box': box_2}]
+        self.record_log('zones: {}\n'.format('custom' if self.zones else 'boxes'))
+        for i, zone in enumerate(zones, 1):
+            self.record_log('zone{}: {}\n'.format(i, json.dumps(zone)))
+        self.zonemap = ZoneMap((self.box0[3] - self.box0[2], self.box0[1] - self.box0[0]), zones
+                               , (self.box0[0], self.box0[2]), self.hysteresis)
+        # zones 1 and 2 are stimulated like box1 and box2, further zones are only recorded
+        if self.zones:
+            # zones 1 and 2 are ordered by their centers, as the boxes are
+            centers = [self.zonemap.center(1), self.zonemap.center(2)]
+            if None in centers:
+                raise ValueError('zones 1 and 2 have to be inside of box0')
+            first = 1 if (centers[0][0] > centers[1][0]) == (self.firstbox == 'right') else 2
+        else:
+            first = 1 if self.boxorder[0] is self.box1 else 2
+        self.zoneorder = [first, 3 - first]
 
     def habituation(self):
+        self.open_control()
+        try:
+            self._habituation()
+        finally:
+            self.close_control()
+
+    def _habituation(self):
         s = time.time()
         adaptation_time = self.adaptation * 60
-        cap = PiRGBArray(self.camera, size=self.camera.resolution)
-        for frame in self.camera.capture_continuous(cap, format='bgr', use_video_port=True):
-            image = frame.array
-            key = cv2.waitKey(1)&0xFF
-            if key == ord('q'):
+        self.open_display()
+        lastsample = 0
+        frames = self.frame_source().frames()
+        for frame in frames:
+            if self.tracker != 'threshold' and time.time() - lastsample >= 1:
+                self.add_background_sample(frame.gray)
+                lastsample = time.time()
+            if self.quit_requested():
                 break
             current_remain = adaptation_time- (time.time()-s)
             if current_remain <= 0:
@@ -280,123 +1538,395 @@ class RPP(object):
                 remaining = "{} min".format(int(current_remain/60))
             else:
                 remaining = "{} sec".format(int(current_remain))
-            outline_text(image,'adaptation_time: {} left. "q" for quiting adaptation'.format(remaining)
-                         , (30, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (20, 20, 20), 2)
+            if self.viewing():
+                image = frame.color().copy()
+                outline_text(image,'adaptation_time: {} left. "q" for quiting adaptation'.format(remaining)
+                             , (30, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (20, 20, 20), 2)
+                self.show(image)
+        frames.close()
+        self.close_display()
+        if self.tracker != 'threshold':
+            self.build_background()
+
+    def open_control(self):
+        '''take over SIGINT/SIGTERM/SIGUSR1 and stdin in headless mode, until close_control'''
+        if self.headless and self.control is None:
+            self.control = ControlChannel()
+
+    def close_control(self):
+        '''restore the signal handlers; commands not handled yet are dropped'''
+        if self.control is not None:
+            self.control.close()
+            self.control = None
+
+    def frame_source(self):
+        '''return the frame source, opening it the first time'''
+        if isinstance(self.source, str):
+            self.source = open_source(self.source, self.camera)
+        return self.source
+
+    def viewing(self):
+        '''return True if frames are shown in the live window or the preview'''
+        return not self.headless or self.preview is not None
+
+    def open_display(self):
+        '''start the preview thread in headless mode if a preview rate is set'''
+        if self.headless and self.previewrate > 0:
+            self.preview = Preview(self.previewrate, self.previewscale)
+
+    def close_display(self):
+        if self.preview is not None:
+            self.preview.close()
+            self.preview = None
+        if not self.headless:
+            cv2.destroyAllWindows()
+
+    def show(self, image):
+        '''show a frame in the live window, or hand it to the preview thread in headless mode'''
+        if not self.headless:
             cv2.imshow('live', image)
-            cap.truncate(0)
-        cv2.destroyAllWindows()
+        elif self.preview is not None:
+            self.preview.update(image)
+
+    def quit_requested(self):
+        '''return True if the operator asked to quit: "q" in the live window,
+           or a "q" line on stdin or a signal in headless mode'''
+        if not self.headless:
+            return cv2.waitKey(1)&0xFF == ord('q')
+        command = self.control.poll()
+        if command == 's':
+            sys.stderr.write('status: period {}, frames {}, last position {}, laser {}\n'.format(
+                self.period, len(self.location), self.lastcenter, int(self.stimulator.active)))
+        return command == 'q'
 
     def get_center(self, image):
-        '''find the laregest controur from an image and retrun the cordinate of its moment center'''
-        grayimage = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        retVal, binary_image = cv2.threshold(grayimage, self.threshold, 255, cv2.THRESH_BINARY_INV)
-        contours, hierarchy = cv2.findContours(binary_image, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
-        target = max(contours, key =cv2.contourArea)
-        M = cv2.moments(target)
-        x = int(M['m10'] / M['m00'])
-        y = int(M['m01'] / M['m00'])
-        cv2.circle(image, (x,y), 5, (255,255,255), -1)
+        '''return the cordinate of the animal in a box0 crop with the selected tracker'''
+        if self.tracker == 'threshold':
+            return self.get_center_threshold(image)
+        return self.get_center_background(image)
+
+    def get_center_threshold(self, image):
+        '''find the largest dark blob in an image and return the cordinate of its center.
+           the search is limited to a window around the last position and falls back
+           to the whole image when the animal is lost'''
+        grayimage = to_gray(image)
+        self.timer.mark('convert')
+        center = None
+        if self.lastcenter is not None and self.searchwindow > 0:
+            lastx, lasty = self.lastcenter
+            height, width = grayimage.shape
+            x0, y0 = max(0, lastx - self.searchwindow), max(0, lasty - self.searchwindow)
+            x1, y1 = min(width, lastx + self.searchwindow), min(height, lasty + self.searchwindow)
+            center = find_blob(grayimage[y0:y1, x0:x1], self.threshold, border=True)
+            if center is not None:
+                center = (center[0] + x0, center[1] + y0)
+        if center is None:
+            center = find_blob(grayimage, self.threshold)
+        self.timer.mark('search')
+        if center is None:
+            self.lastcenter = None
+            raise ValueError('no target found')
+        x, y = int(center[0]), int(center[1])
+        self.lastcenter = (x, y)
+        return (x, y)
+
+    def small_gray(self, image):
+        '''downscaled gray image for the background model'''
+        small = cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return to_gray(small)
+
+    def add_background_sample(self, image):
+        '''keep the box0 crop of a full frame as a sample for the background model'''
+        crop = image[self.box0[2]:self.box0[3], self.box0[0]:self.box0[1]]
+        self.backgroundsamples.append(self.small_gray(crop))
+        if len(self.backgroundsamples) > 120:
+            self.backgroundsamples.pop(0)
+
+    def build_background(self):
+        '''make the background model from the per-pixel median of the samples,
+           so that a moving animal is left out'''
+        if not self.backgroundsamples:
+            return
+        self.background = np.median(np.stack(self.backgroundsamples), axis=0).astype(np.float32)
+        self.background8 = self.background.astype(np.uint8)
+        self.record_log('background model: median of {} frames\n'.format(len(self.backgroundsamples)))
+        self.backgroundsamples = []
+
+    def get_center_background(self, image):
+        '''find the largest blob that differs from the background model, at reduced
+           resolution, and return its cordinate in the full resolution box0 crop.
+           with the average tracker the background keeps adapting outside the blob'''
+        gray = self.small_gray(image)
+        if self.background is None: # no samples from habituation
+            self.background = gray.astype(np.float32)
+            self.background8 = gray
+        self.timer.mark('convert')
+        diff = cv2.absdiff(gray, self.background8)
+        retVal, foreground = cv2.threshold(diff, self.difference, 255, cv2.THRESH_BINARY)
+        center, area = largest_component(foreground)
+        if self.tracker == 'average':
+            cv2.accumulateWeighted(gray, self.background, self.learningrate, mask=cv2.bitwise_not(foreground))
+            self.background8 = self.background.astype(np.uint8)
+        self.timer.mark('search')
+        if center is None or area < self.minarea:
+            self.lastcenter = None
+            raise ValueError('no target found')
+        x, y = int(center[0] / self.scale), int(center[1] / self.scale)
+        self.lastcenter = (x, y)
         return (x, y)
 
-    def switch_laser(self, image):
-        '''turn on/off laser by finding the center of target in the image'''
+    def switch_laser(self, image, view=None):
+        '''turn on/off laser by finding the center of target in the image.
+           with a predictor the decision uses the position expected predict s after the
+           frame, which also carries the laser over single missed detections.
+           position and status are drawn on view, if given'''
         try:
             x, y = self.get_center(image)
-            in_box1 = in_box(x, y, self.box1)
-            if self.laser_switch_settings[self.period]: # if in a session
-                if in_box(x, y, self.boxorder[self.laser_switch_settings[self.period] - 1]):
-                    # if the target in the box
-                    outline_text(image, 'ON', (30, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0 , 0, 255), 2)
-                    if self.trigger.value == 0: # if laser was off
-                        self.trigger.on()
-                        self.trigger.blink(on_time=self.ontime, off_time=self.offtime)
-                else: # if the target is not in the box
-                    outline_text(image, 'OFF', (30, 50), cv2.FONT_HERSHEY_SIMPLEX,1, (20, 20, 20), 2)
-                    self.trigger.off()
-            else:  # if not in a session
-                self.trigger.off()
-                if self.period == 0:
-                    outline_text(image,'presession', (30, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (20, 20, 20), 2)
-                else:
-                    outline_text(image,'break', (30 ,50), cv2.FONT_HERSHEY_SIMPLEX, 1, (20, 20, 20), 2)
+            zone = self.zonemap.zone(x, y)
+            position = (x, y)
         except: #if either finding contrast or center fails
-            outline_text(image,'cannot detect', (30, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (20, 20, 20), 2)
-            self.trigger.off()
             x, y = 0, 0
-            in_box1 = np.nan # record as NAN if location unidentifiable
-        return x, y, in_box1
+            zone = -1 # record as -1 if location unidentifiable
+            position = None
+        decision, pzone = position, zone
+        if self.predictor is not None:
+            self.predictor.update(self.current_time, position)
+            decision = self.predictor.predict(self.current_time + self.predict)
+            if decision is not None:
+                decision = (int(round(decision[0])), int(round(decision[1])))
+            pzone = self.zonemap.zone(*decision) if decision is not None else -1
+        px, py = decision if decision is not None else (0, 0)
+        setting = self.laser_switch_settings[self.period]
+        # 0: not in a session, 1 or 2: stimulation in the first or second zone of zoneorder
+        inzone = inmargin = False
+        if setting and decision is not None:
+            target = self.zoneorder[setting - 1]
+            inzone = pzone == target
+            inmargin = inzone or self.zonemap.in_zone(px, py, target, enlarged=True)
+        active = self.stimulator.update(self.current_time, inzone, inmargin)
+        if decision is None:
+            label, color = 'cannot detect', (20, 20, 20)
+        elif not setting:
+            label, color = ('presession' if self.period == 0 else 'break'), (20, 20, 20)
+        elif active:
+            label, color = 'ON', (0 , 0, 255)
+        else:
+            label, color = 'OFF', (20, 20, 20)
+        self.timer.mark('decision')
+        # drawn after the laser is switched so that drawing does not delay it
+        if view is not None:
+            if position is not None:
+                cv2.circle(view, (x,y), 5, (255,255,255), -1)
+            if self.predictor is not None and decision is not None:
+                cv2.circle(view, (px,py), 7, (255,255,255), 1)
+            outline_text(view, label, (30, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
+        self.timer.mark('draw')
+        return x, y, zone, px, py, pzone
 
     def tracking(self):
         '''track animal and turn on/off laser'''
-        Q = queue.Queue()
-        cap = PiRGBArray(self.camera, size=self.camera.resolution)
+        self.open_control()
+        try:
+            self._tracking()
+        finally:
+            self.close_control()
+
+    def _tracking(self):
+        self.framestore = FrameStore(self.framestorepath, meta={'record': self.record, 'box0': self.box0
+            , 'resolution': list(self.camera.resolution), 'tilesize': self.tilesize})
+        encoder = EncoderPool(self.store_frame, workers=self.encoders, maxsize=self.encodequeue
+                              , failure=self.frame_failed)
+        frameinterval = 1 / self.framerate
+        source = self.frame_source()
         self.record_log('session start:{}\n'.format(datetime.datetime.now()))
         sessionst = time.time()
-        for frame in self.camera.capture_continuous(cap, format='bgr', use_video_port=True):
-            image = frame.array
-            T = threading.Thread(target=compress, args=(Q, image,))
-            T.start() 
-            key = cv2.waitKey(1)&0xFF
-            if key == ord('q'):
-                break
-            current_time = time.time() - sessionst
-            if current_time >= self.times[self.period]:
-                self.period += 1
-            if self.period == len(self.times):
-                break
-            # trim image accroding to box cordinates
-            image = image[self.box0[2]:self.box0[3], self.box0[0]:self.box0[1]]
-            x, y, in_box1 = self.switch_laser(image)
-            self.locationlist.append((self.period, x, y, in_box1, self.trigger.value, current_time))
-            # save info:  period, x cordinate, y cordinate, in_box1, if trigger was on, time
-            T.join()
-            cv2.imshow('live', image)
-            self.framelist.append(Q.get())
-            cap.truncate(0)
-        cv2.destroyAllWindows()
+        self.stimulator.starttime = sessionst
+        self.lastcenter = None
+        if self.timing:
+            self.timer = StageTimer(os.path.join(self.dirpath, 'timing.txt'))
+        self.open_display()
+        frames = source.frames()
+        # whatever ends the session, the capture, the recording and the stimulation
+        # (its thread and the trigger, left off) are closed
+        try:
+            for frame in frames:
+                arrival = frame.time # capture time, given by the frame source
+                self.timer.start(arrival - sessionst)
+                quit = self.quit_requested()
+                self.timer.mark('waitkey')
+                if quit:
+                    break
+                current_time = arrival - sessionst
+                image = self.process_frame(frame, current_time, encoder)
+                if image is None:
+                    break
+                if time.time() - arrival > frameinterval: # laser decision took longer than a frame
+                    self.lateframes += 1
+                self.show(image)
+                self.timer.mark('display')
+                encoder.drain()
+                self.timer.end()
+        finally:
+            frames.close()
+            self.close_display()
+            encoder.close()
+            self.framestore.close()
+            source.close()
+            self.stimulator.close()
         sys.stdout.write('image collection done\n')
         self.record_log('session end:{}\n'.format(datetime.datetime.now()))
-        self.camera.close()
-        self.trigger.off()
+        self.record_log('frames: {}, dropped by encoder: {}, failed to encode: {}, late: {}, dropped by capture: {}\n'.format(
+            len(self.location), encoder.dropped, encoder.failed, self.lateframes, source.dropped))
+        if self.timing:
+            self.timer.close()
+            self.record_log('camera frame rate: {} fps\n'.format(self.framerate))
+            for line in self.timer.summary():
+                self.record_log(line)
+            if encoder.encoded:
+                self.record_log('timing encode (encoder threads): mean {:.2f} ms, max {:.2f} ms\n'.format(
+                    1000 * encoder.encodetime / encoder.encoded, 1000 * encoder.maxencodetime))
+            self.timer = NullTimer()
+        if self.owncamera:
+            self.camera.close()
+        self.record_log('stimulation pulses: {}\n'.format(self.stimulator.pulses))
+
+    def process_frame(self, image, current_time, encoder=None):
+        '''one tracking step on a full camera frame (a BGR array or a CapturedFrame):
+           update the period, pass the frame to the encoder, locate the animal and switch
+           the laser. return the trimmed, annotated image, or None when the session is over'''
+        if current_time >= self.times[self.period]:
+            self.period += 1
+        if self.period == len(self.times):
+            return None
+        if encoder is not None:
+            self.submit_frame(encoder, image, current_time)
+        self.timer.mark('submit')
+        # trim image accroding to box cordinates
+        crop = (slice(self.box0[2], self.box0[3]), slice(self.box0[0], self.box0[1]))
+        if isinstance(image, CapturedFrame):
+            # track on the luminance plane, the color image is only made to be shown
+            view = image.color()[crop] if self.annotate and self.viewing() else None
+            image = image.gray[crop]
+        else:
+            image = image[crop]
+            view = image if self.annotate else None
+        self.current_time = current_time
+        x, y, zone, px, py, pzone = self.switch_laser(image, view)
+        self.location.append(self.period, x, y, zone, int(self.stimulator.active), current_time, px, py, pzone)
+        # save info:  period, x cordinate, y cordinate, zone, if stimulation was on, time,
+        # position and zone used for the laser decision
+        return view if view is not None else image
+
+    def submit_frame(self, encoder, image, current_time):
+        '''pass a full frame to the encoder as the recording mode asks: the full frame,
+           the box0 crop, or the changed tiles of the crop. keyframes are full frames'''
+        # the frame number links a recorded frame to its record in the location log
+        frameno = len(self.location)
+        due = self.keyframe > 0 and (self.lastkeyframe is None or current_time - self.lastkeyframe >= self.keyframe)
+        if self.record == 'tiles':
+            # one keyframe in the encoder at a time; it becomes the reference once stored
+            keyframe = self.pendingreference is None and (self.reference is None or due)
+        else:
+            keyframe = self.record == 'full' or due
+        if keyframe:
+            if encoder.submit(image, (frameno, current_time, self.period, FRAME_FULL)):
+                self.lastkeyframe = current_time
+                if self.record == 'tiles':
+                    # gray of the BGR image, as encode_tiles compares it: the Y plane of the
+                    # camera differs from the gray of its YUV to BGR conversion
+                    color = image.color() if isinstance(image, CapturedFrame) else image
+                    crop = color[self.box0[2]:self.box0[3], self.box0[0]:self.box0[1]]
+                    self.pendingreference = (frameno, to_gray(crop).copy())
+        elif self.record == 'crop' or self.pendingreference is not None or self.reference is None:
+            # tiles would be pasted on the pending keyframe, which may not be stored: crops
+            # need the keyframe only outside of box0
+            encoder.submit(image, (frameno, current_time, self.period, FRAME_CROP)
+                           , functools.partial(encode_crop, box0=self.box0))
+        else:
+            encoder.submit(image, (frameno, current_time, self.period, FRAME_TILES)
+                           , functools.partial(encode_tiles, box0=self.box0, reference=self.reference
+                                               , tilesize=self.tilesize, tolerance=self.tiletolerance))
+
+    def store_frame(self, tag, encimg):
+        '''encoder sink: append an encoded frame to the frame store. a stored pending
+           keyframe becomes the tiles reference'''
+        self.framestore.append(encimg, *tag)
+        if self.pendingreference is not None and tag[0] == self.pendingreference[0]:
+            self.reference = self.pendingreference[1]
+            self.pendingreference = None
+
+    def frame_failed(self, tag):
+        '''encoder failure handler: a keyframe that failed to encode is not a reference;
+           the last stored keyframe stays the reference'''
+        if self.pendingreference is not None and tag[0] == self.pendingreference[0]:
+            self.pendingreference = None
+
+    def save_location(self):
+        '''close the location log (location.bin) and export it to location.txt'''
+        self.location.close()
+        if self.savetext:
+            write_location_text(load_location(self.location.path), os.path.join(self.dirpath, 'location.txt'))
+
+    def save_settings(self):
+        '''return what save_session needs to save this session, as a picklable dict'''
+        return {'dirpath': self.dirpath, 'framestorepath': self.framestorepath, 'imagedirpath': self.imagedirpath
+                , 'locationpath': self.location.path, 'framerate': self.framerate, 'record': self.record
+                , 'keepframes': self.keepframes, 'savevideo': self.savevideo, 'transcode': self.transcode
+                , 'archive': self.archive, 'savetext': self.savetext}
 
     def save_data(self):
         '''save image and location data'''
-        sys.stdout.write('start saving file\n')
-        if self.savevideo:
-            videopath = os.path.join(self.dirpath, 'video.mp4')
-            v = skvideo.io.FFmpegWriter(videopath)
-            for i in range(len(self.framelist)):
-                image = cv2.imdecode(self.framelist[i], 1)
-                v.writeFrame(image)
-                if i%10 == 0:
-                    sys.stdout.write('\rprogress: {:3.2f} %'.format(100 * i / len(self.framelist)))
-            sys.stdout.write('\rprogress: 100.00 %\n')
-            v.close()
+        self.location.close()
+        self.log.close()
+        save_session(self.save_settings())
+
+def save_session(settings, progress=show_progress):
+    '''export the frames and locations of a finished session (see RPP.save_settings).
+       needs no RPP object, so that it can run in another process'''
+    sys.stdout.write('start saving file\n')
+    dirpath, framestorepath, imagedirpath = settings['dirpath'], settings['framestorepath'], settings['imagedirpath']
+    frames = FrameStoreReader(framestorepath)
+    error = None
+    if settings['keepframes'] or settings['record'] != 'full':
+        # crops and tiles are read back with RecordingReader
+        sys.stdout.write('frames are kept in {}\n'.format(framestorepath))
+    elif settings['savevideo'] and mjpeg_avi_size(frames, settings['framerate']) > AVI_MAX_SIZE:
+        if shutil.which('ffmpeg') is None:
+            error = ('the session is too long for video.avi (over 4 GB) and ffmpeg is not installed to write'
+                     ' video.mp4: frames are kept in {}'.format(framestorepath))
         else:
-            for i in range(len(self.framelist)):
-                jpgpath = os.path.join(self.imagedirpath, str(i) + '.jpg')
-                outf = open(jpgpath, 'wb')
-                outf.write(self.framelist[i])
-                outf.close()
-                if i % 10 == 0:
-                    sys.stdout.write('\rprogress: {:3.2f} %'.format(100 * i / len(self.framelist)))
+            sys.stdout.write('the session is too long for video.avi (over 4 GB): encoding video.mp4\n')
+            write_ffmpeg_video(frames, os.path.join(dirpath, 'video.mp4'), settings['framerate'], progress=progress)
+            if progress is not None:
+                sys.stdout.write('\rprogress: 100.00 %\n')
+    elif settings['savevideo']:
+        videopath = os.path.join(dirpath, 'video.avi')
+        write_mjpeg_avi(frames, videopath, settings['framerate'], progress=progress)
+        if progress is not None:
             sys.stdout.write('\rprogress: 100.00 %\n')
-            sys.stdout.write("compressing image directory\n")
-            archivepath = os.path.join(self.dirpath, "images.tar.gz")
-            command1 = ["tar", "-czf", archivepath, self.imagedirpath]
-            command2 = ["rm", "-r", self.imagedirpath]
-            subprocess.call(command1)
-            subprocess.call(command2)
-        locationfilepath = os.path.join(self.dirpath, 'location.txt')
-        outf = open(locationfilepath, 'w')
-        outf.write('\t'.join(['period', 'x', 'y', 'in_box1', 'stimulation', 'time'])+'\n')
-        for info in self.locationlist:
-            outf.write('\t'.join([str(x) for x in info])+'\n')
-        outf.close()
-        self.log.close()
-        sys.stdout.write('saving done\n')
+        if settings['transcode']:
+            start_transcode(videopath, os.path.join(dirpath, 'video.mp4'))
+            sys.stdout.write('converting to video.mp4 in background\n')
+    else:
+        archive = settings['archive']
+        archivepath = os.path.join(dirpath, ARCHIVE_MODES[archive][0])
+        boximagepath = os.path.join(imagedirpath, 'boximage.jpg')
+        extrafiles = [boximagepath] if os.path.exists(boximagepath) else []
+        write_archive(frames, archivepath, imagedirpath.lstrip('/'), archive, extrafiles, progress=progress)
+        if progress is not None:
+            sys.stdout.write('\rprogress: 100.00 %\n')
+        shutil.rmtree(imagedirpath)
+    frames.close()
+    if not settings['keepframes'] and settings['record'] == 'full' and error is None:
+        shutil.rmtree(framestorepath)
+    if settings['savetext']:
+        write_location_text(load_location(settings['locationpath']), os.path.join(dirpath, 'location.txt'))
+    if error is not None:
+        raise ValueError(error)
+    sys.stdout.write('saving done\n')
 
-if __name__ == '__main__':  
+def build_parser():
+    '''return the command line parser of RPP.py, also used for the jobs of RPP_daemon.py'''
     parser = argparse.ArgumentParser()
     parser.add_argument('animalID', type=str, help='animal ID')
     parser.add_argument('-d', '--dir', type=str, default='./', help='data directory')
@@ -426,14 +1956,80 @@ if __name__ == '__main__':
                         , help='GPIO PIN# for the trigger (default:14)')
     parser.add_argument('-t', '--threshold', type=int, default=30
                         , help='threshold for binarizing images(default:30)')
+    parser.add_argument('--calibrate', type=float, default=3
+                        , help='seconds of frames buffered when "a" is pressed in camera setting to find the threshold(default:3)')
+    parser.add_argument('-w', '--searchwindow', type=int, default=80
+                        , help='half size of the search window around the last position in pixels, 0 to search the whole field(default:80)')
+    parser.add_argument('--hysteresis', type=int, default=0
+                        , help='stimulation continues until the animal is this many pixels out of the zone(default:0)')
+    parser.add_argument('--zones', type=str, default=None
+                        , help='JSON file with a list of polygon, ellipse or box zones in camera cordinates; zones 1 and 2 are stimulated instead of the boxes(default: the two boxes)')
+    parser.add_argument('--mindwell', type=float, default=0
+                        , help='seconds in the box before stimulation starts(default:0)')
+    parser.add_argument('--predict', type=float, default=None
+                        , help='decide on the position predicted this many seconds after each frame by a constant-velocity Kalman filter, which also bridges single missed detections, e.g. 0.1(default: off)')
+    parser.add_argument('--tracker', choices=['threshold', 'median', 'average'], default='threshold'
+                        , help='threshold: dark blob below --threshold. median: difference from a background made during adaptation. average: as median, and the background keeps adapting(default: threshold)')
+    parser.add_argument('--scale', type=float, default=0.5
+                        , help='image scale for the background trackers(default:0.5)')
+    parser.add_argument('--difference', type=int, default=25
+                        , help='gray level difference from the background for the background trackers(default:25)')
+    parser.add_argument('--encoders', type=int, default=2
+                        , help='number of JPEG encoder threads(default:2)')
+    parser.add_argument('--encodequeue', type=int, default=8
+                        , help='frames waiting for encoding before new frames are dropped(default:8)')
+    parser.add_argument('--keepframes', action='store_true'
+                        , help='keep frames in the seekable frame store (frames/) instead of exporting images or video')
+    parser.add_argument('--record', choices=RECORD_MODES, default='full'
+                        , help='full: whole camera frames. crop: only the field (box0). tiles: only the tiles of the field that changed since the last keyframe. crop and tiles are kept in frames/(default: full)')
+    parser.add_argument('--keyframe', type=float, default=None
+                        , help='seconds between full-frame keyframes with --record crop or tiles, 0 for none with crop(default: 0 for crop, 10 for tiles)')
+    parser.add_argument('--tilesize', type=int, default=32
+                        , help='tile size in pixels for --record tiles(default:32)')
+    parser.add_argument('--tiletolerance', type=float, default=4
+                        , help='mean gray level change for a tile to be recorded with --record tiles(default:4)')
+    parser.add_argument('--archive', choices=sorted(ARCHIVE_MODES), default='tar'
+                        , help='archive format for image files: tar and zip are stored uncompressed, targz is the old images.tar.gz(default:tar)')
+    parser.add_argument('--timing', action='store_true'
+                        , help='record durations of each step of tracking in timing.txt and a summary in log.txt')
+    parser.add_argument('--notext', action='store_false', dest='savetext'
+                        , help='save locations only in binary location.bin, without location.txt')
+    parser.add_argument('--headless', action='store_true'
+                        , help='no live window during adaptation and session. type "q" + enter to quit, "s" + enter for status')
+    parser.add_argument('--preview', type=float, default=0
+                        , help='with --headless, show a small preview this many times per second(default:0, no preview)')
+    parser.add_argument('--previewscale', type=float, default=0.5
+                        , help='size of the preview relative to the frame(default:0.5)')
+    parser.add_argument('--source', type=str, default='picamera'
+                        , help='frames from picamera, synthetic (a moving disk), or a video file or device number for OpenCV(default: picamera)')
     parser.add_argument('--savevideo', action='store_true'
-                        , help='save a video file, not image files(take time)')
-    args = parser.parse_args()
-    R = RPP(args.animalID, args.session, args.noalternate, dir=args.dir
-            , resolution=(args.xresolution, args.yresolution)
-            , framerate=args.framerate, frequency=args.hz, breaktime=args.breaktime, adaptation=args.adaptation
-            , pre_session=args.pre_session, pulselength=args.pulselength
-            , threshold=args.threshold, right_first=args.left, pin=args.pin, savevideo=args.savevideo)
+                        , help='save an MJPEG video file (video.avi), not image files')
+    parser.add_argument('--transcode', action='store_true'
+                        , help='with --savevideo, also convert the video to video.mp4 in background(needs ffmpeg)')
+    return parser
+
+def rpp_from_args(args, **keywords):
+    '''return an RPP object set up by parsed command line options. keywords are
+       passed to RPP and override the options'''
+    settings = dict(dir=args.dir
+                    , source=args.source, camera=None if args.source == 'picamera' else SimulatedCamera()
+                    , predict=args.predict, record=args.record, keyframe=args.keyframe, tilesize=args.tilesize, tiletolerance=args.tiletolerance
+                    , resolution=(args.xresolution, args.yresolution)
+                    , framerate=args.framerate, frequency=args.hz, breaktime=args.breaktime, adaptation=args.adaptation
+                    , pre_session=args.pre_session, pulselength=args.pulselength
+                    , threshold=args.threshold, calibrate=args.calibrate, searchwindow=args.searchwindow, right_first=args.left, pin=args.pin, savevideo=args.savevideo
+                    , encoders=args.encoders, encodequeue=args.encodequeue, keepframes=args.keepframes
+                    , archive=args.archive, transcode=args.transcode, timing=args.timing
+                    , savetext=args.savetext, headless=args.headless, previewrate=args.preview
+                    , previewscale=args.previewscale, hysteresis=args.hysteresis, mindwell=args.mindwell
+                    , tracker=args.tracker, scale=args.scale, difference=args.difference
+                    , zones=json.load(open(args.zones)) if args.zones else None)
+    settings.update(keywords)
+    return RPP(args.animalID, args.session, args.noalternate, **settings)
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    R = rpp_from_args(args)
     R.initial_log()
     sys.stderr.write('start recording {}\n'.format(args.animalID))
     sys.stderr.write('select box areas\n')
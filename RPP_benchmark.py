@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+'''benchmarks for RPP.py'''
+
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import shutil
+import subprocess
+import resource
+import platform
+import multiprocessing
+import cv2
+import numpy as np
+import RPP
+import RPP_replay
+
+def synthetic_store(path, nframes, framesize, framerate):
+    '''fill a frame store with random bytes of about framesize per frame.
+       random bytes do not compress, like JPEG data'''
+    rng = np.random.default_rng(0)
+    store = RPP.FrameStore(path)
+    for i in range(nframes):
+        size = int(framesize * rng.uniform(0.9, 1.1))
+        store.append(rng.integers(0, 256, size, dtype=np.uint8), i, i / framerate, 0)
+    store.close()
+
+def archive_legacy(frames, workdir):
+    '''previous save_data path: one file per frame, tar -czf, then removing the files'''
+    imagedirpath = os.path.join(workdir, 'images')
+    os.mkdir(imagedirpath)
+    for record, encimg in frames:
+        outf = open(os.path.join(imagedirpath, '{}.jpg'.format(record['frame'])), 'wb')
+        outf.write(encimg)
+        outf.close()
+    archivepath = os.path.join(workdir, 'images.tar.gz')
+    subprocess.call(['tar', '-czf', archivepath, imagedirpath])
+    shutil.rmtree(imagedirpath)
+    return archivepath
+
+def archive_single_pass(fmt):
+    '''save_data path with write_archive'''
+    def run(frames, workdir):
+        archivepath = os.path.join(workdir, RPP.ARCHIVE_MODES[fmt][0])
+        RPP.write_archive(frames, archivepath, 'images', fmt)
+        return archivepath
+    return run
+
+def bench_archive(args):
+    '''compare archive writers on a synthetic session'''
+    nframes = int(args.minutes * 60 * args.framerate)
+    methods = [('legacy', archive_legacy)] + [(fmt, archive_single_pass(fmt)) for fmt in args.formats]
+    results = []
+    workdir = tempfile.mkdtemp(dir=args.dir)
+    storepath = os.path.join(workdir, 'frames')
+    sys.stdout.write('writing {} synthetic frames\n'.format(nframes))
+    synthetic_store(storepath, nframes, args.framesize, args.framerate)
+    for name, method in methods:
+        frames = RPP.FrameStoreReader(storepath)
+        s = time.time()
+        archivepath = method(frames, workdir)
+        os.sync() # include the time to reach the card
+        elapsed = time.time() - s
+        frames.close()
+        results.append({'benchmark': 'archive', 'method': name, 'frames': nframes
+                        , 'seconds': elapsed, 'bytes': os.path.getsize(archivepath)})
+        os.remove(archivepath)
+        sys.stdout.write('{}\t{:.2f} s\t{:.1f} MB\n'.format(name, elapsed, results[-1]['bytes'] / 2**20))
+    shutil.rmtree(workdir)
+    return results
+
+RESOLUTIONS = {'480p': (640, 480), '720p': (1280, 720), '1080p': (1920, 1080)}
+
+def arena_boxes(arena, width, height):
+    '''return box0, box1, box2 in camera cordinates ([x1, y1, x2, y2]) for an arena preset.
+       full: the whole frame split in left and right halves.
+       center: the central 60 % of the frame split in left and right halves.
+       corners: the whole frame with two boxes of a quarter size in the corners'''
+    if arena == 'full':
+        return [0, 0, width, height], [0, 0, width // 2, height], [width // 2, 0, width, height]
+    elif arena == 'center':
+        x0, y0, x1, y1 = int(0.2 * width), int(0.2 * height), int(0.8 * width), int(0.8 * height)
+        xm = (x0 + x1) // 2
+        return [x0, y0, x1, y1], [x0, y0, xm, y1], [xm, y0, x1, y1]
+    elif arena == 'corners':
+        return ([0, 0, width, height], [0, 0, width // 4, height // 2]
+                , [width - width // 4, height // 2, width, height])
+    raise ValueError('unknown arena: {}'.format(arena))
+
+class ArenaSource(RPP.SyntheticSource):
+    '''synthetic luminance frames, as the camera source yields them, with the dark disk
+       moving through box0 of the arena'''
+    def __init__(self, camera, box0):
+        RPP.SyntheticSource.__init__(self, camera, realtime=False)
+        self.box0 = box0
+
+    def render(self, slot, t):
+        '''draw the frame at time t (s) into slot; the disk follows a Lissajous path crossing both boxes'''
+        x1, y1, x2, y2 = self.box0
+        r = self.radius
+        x = int(x1 + r + (x2 - x1 - 2 * r) * (0.5 + 0.5 * np.sin(0.7 * t)))
+        y = int(y1 + r + (y2 - y1 - 2 * r) * (0.5 + 0.5 * np.sin(1.1 * t)))
+        slot[:] = self.background
+        cv2.circle(slot, (x, y), r, 10, -1)
+
+class DecisionTimer(RPP.NullTimer):
+    '''stage timer that keeps the time of the laser decision mark of RPP.switch_laser'''
+    def __init__(self):
+        self.decision = None
+
+    def mark(self, stage):
+        if stage == 'decision':
+            self.decision = time.perf_counter()
+
+def run_latency(config):
+    '''run the per-frame path of RPP.tracking on synthetic camera frames (CapturedFrame,
+       tracked on the luminance plane) with the threaded stimulation scheduler, for one
+       configuration. latency is timed from frame arrival to the laser decision, frame
+       time to the end of process_frame (drawing, logging). run in its own process so
+       the peak memory belongs to this configuration'''
+    resolution, arena, tracker, nframes, framerate, headless, workdir = config
+    width, height = RESOLUTIONS[resolution]
+    box0, box1, box2 = arena_boxes(arena, width, height)
+    camera = RPP.SimulatedCamera()
+    R = RPP.RPP('bench', 10 ** 6, True, camera=camera, trigger=RPP_replay.FakeTrigger(), stimthread=True
+                , dirpath=tempfile.mkdtemp(dir=workdir), resolution=(width, height), framerate=framerate
+                , pre_session=0, tracker=tracker, headless=headless)
+    R.set_boxes(box0, box1, box2)
+    camera.resolution = (width, height)
+    camera.framerate = framerate
+    source = ArenaSource(camera, box0)
+    if tracker != 'threshold':
+        R.add_background_sample(source.background)
+        R.build_background()
+    timer = R.timer = DecisionTimer()
+    encoder = RPP.EncoderPool(lambda tag, encimg: None, workers=R.encoders, maxsize=R.encodequeue)
+    latencies = np.zeros(nframes)
+    frametimes = np.zeros(nframes)
+    frames = source.frames()
+    s = time.perf_counter()
+    for i in range(nframes):
+        frame = next(frames)
+        arrival = time.perf_counter()
+        R.process_frame(frame, i / framerate, encoder)
+        latencies[i] = timer.decision - arrival
+        frametimes[i] = time.perf_counter() - arrival
+        encoder.drain()
+    frames.close()
+    encoder.close()
+    elapsed = time.perf_counter() - s
+    R.stimulator.close()
+    R.location.close()
+    R.log.close()
+    shutil.rmtree(R.dirpath)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+    f50, f99 = np.percentile(frametimes, [50, 99]) * 1000
+    return {'benchmark': 'latency', 'resolution': resolution, 'width': width, 'height': height
+            , 'arena': arena, 'tracker': tracker, 'headless': headless, 'frames': nframes
+            , 'latency_ms_p50': p50, 'latency_ms_p90': p90
+            , 'latency_ms_p99': p99, 'latency_ms_max': latencies.max() * 1000
+            , 'frame_ms_p50': f50, 'frame_ms_p99': f99, 'frame_ms_max': frametimes.max() * 1000
+            , 'fps': nframes / elapsed, 'dropped': encoder.dropped
+            , 'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            , 'python': platform.python_version(), 'opencv': cv2.__version__, 'machine': platform.machine()}
+
+def bench_latency(args):
+    '''time capture-to-trigger latency over resolutions and arenas'''
+    workdir = tempfile.mkdtemp(dir=args.dir)
+    configs = [(r, a, t, args.frames, args.framerate, args.headless, workdir)
+               for r in args.resolutions for a in args.arenas for t in args.trackers]
+    results = []
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        for result in pool.imap(run_latency, configs):
+            results.append(result)
+            sys.stdout.write('{resolution}\t{arena}\t{tracker}\tdecision p50 {latency_ms_p50:.2f} ms\tp99 {latency_ms_p99:.2f} ms'
+                             '\tframe p50 {frame_ms_p50:.2f} ms\tp99 {frame_ms_p99:.2f} ms'
+                             '\t{fps:.1f} fps\t{maxrss_mb:.0f} MB\n'.format(**result))
+    shutil.rmtree(workdir)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', type=str, default=None
+                        , help='save results as JSON to this file')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    archive = subparsers.add_parser('archive', help='time save_data archive writers')
+    archive.add_argument('-d', '--dir', type=str, default='./'
+                         , help='directory to write to, use the data directory of the rig(default: ./)')
+    archive.add_argument('-m', '--minutes', type=float, default=40
+                         , help='recorded session length in minutes(default:40)')
+    archive.add_argument('-f', '--framerate', type=int, default=10
+                         , help='video framerate(fps, default:10)')
+    archive.add_argument('-b', '--framesize', type=int, default=20000
+                         , help='mean size of an encoded frame in bytes(default:20000)')
+    archive.add_argument('--formats', nargs='+', default=['tar', 'zip']
+                         , choices=sorted(RPP.ARCHIVE_MODES), help='single-pass formats to compare(default: tar zip)')
+    archive.set_defaults(run=bench_archive)
+    latency = subparsers.add_parser('latency', help='time the per-frame path from frame to laser decision')
+    latency.add_argument('-d', '--dir', type=str, default=tempfile.gettempdir()
+                         , help='directory for temporary session files(default: system temp)')
+    latency.add_argument('-n', '--frames', type=int, default=600
+                         , help='frames per configuration(default:600)')
+    latency.add_argument('-f', '--framerate', type=int, default=30
+                         , help='frame rate used for frame times(fps, default:30)')
+    latency.add_argument('-r', '--resolutions', nargs='+', default=sorted(RESOLUTIONS)
+                         , choices=sorted(RESOLUTIONS), help='frame sizes(default: all)')
+    latency.add_argument('-a', '--arenas', nargs='+', default=['full', 'center', 'corners']
+                         , choices=['full', 'center', 'corners'], help='arena presets(default: all)')
+    latency.add_argument('-t', '--trackers', nargs='+', default=['threshold']
+                         , choices=['threshold', 'median', 'average'], help='tracking methods(default: threshold)')
+    latency.add_argument('-H', '--headless', action='store_true'
+                         , help='as RPP.py --headless: no color conversion or drawing for the live window')
+    latency.set_defaults(run=bench_latency)
+    args = parser.parse_args()
+    results = args.run(args)
+    if args.output:
+        outf = open(args.output, 'w')
+        json.dump(results, outf, indent=1)
+        outf.close()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+'''runs RPP sessions back to back with the camera and the GPIO kept open.
+   jobs (RPP.py options with the animal ID) come from a local socket; the data of a
+   finished session is saved by a background process while the next one starts'''
+
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+import traceback
+import multiprocessing
+import RPP
+
+class JobServer(object):
+    '''accepts requests on a unix socket, one JSON object per line, and answers each
+       with one JSON line. {"args": ["A1", "-s", "10"], "reuse": false} queues a session
+       with RPP.py options, {"command": "status"} and {"command": "stop"} are answered
+       by the daemon'''
+    def __init__(self, path, status):
+        self.path = path
+        self.status = status
+        self.jobs = queue.Queue()
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(4)
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        '''server loop: one connection at a time, until the socket is closed'''
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            f = conn.makefile('rw')
+            for l in f:
+                f.write(json.dumps(self.handle(l)) + '\n')
+                f.flush()
+            f.close()
+            conn.close()
+
+    def handle(self, line):
+        '''return the answer to one request'''
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {'error': 'request is not JSON'}
+        command = request.get('command', 'run')
+        if command == 'status':
+            return self.status()
+        elif command == 'stop':
+            self.jobs.put(None)
+            return {'stopping': True}
+        elif command == 'run':
+            try:
+                args = RPP.build_parser().parse_args(request.get('args', []))
+            except SystemExit: # argparse has written the reason to stderr of the daemon
+                return {'error': 'invalid RPP.py options: {}'.format(' '.join(request.get('args', [])))}
+            self.jobs.put((args, request.get('reuse', False)))
+            return {'queued': args.animalID, 'waiting': self.jobs.qsize()}
+        return {'error': 'unknown command: {}'.format(command)}
+
+    def close(self):
+        self.sock.close()
+        os.remove(self.path)
+
+class RigDaemon(object):
+    '''keeps the camera and the triggers open and runs queued sessions in order'''
+    def __init__(self, socketpath):
+        self.camera = RPP.PiCamera()
+        self.triggers = {} # GPIO pin: LED
+        self.saving = [] # (animal ID, save process)
+        self.current = None
+        self.session = None # RPP object of the running session
+        self.last = None # camera settings and boxes of the last session, for "reuse"
+        self.lastend = None
+        self.context = multiprocessing.get_context('spawn')
+        self.server = JobServer(socketpath, self.status)
+
+    def trigger(self, pin):
+        '''return the trigger on pin, opened the first time'''
+        if pin not in self.triggers:
+            self.triggers[pin] = RPP.LED(pin)
+        return self.triggers[pin]
+
+    def status(self):
+        return {'current': self.current, 'waiting': self.server.jobs.qsize()
+                , 'saving': [animalID for animalID, p in self.saving if p.is_alive()]}
+
+    def run_session(self, args, reuse):
+        '''run one session; reuse takes the camera settings, threshold and boxes of the
+           last session instead of asking for them'''
+        keywords = {'trigger': self.trigger(args.pin), 'stimthread': True}
+        if args.source == 'picamera':
+            keywords['camera'] = self.camera
+        reuse = reuse and self.last is not None
+        if reuse:
+            keywords.update({k: self.last[k] for k in ['threshold', 'brightness', 'contrast']})
+        R = self.session = RPP.rpp_from_args(args, **keywords)
+        R.initial_log()
+        if self.lastend is not None:
+            R.record_log('rig daemon: {:.1f} s since the last session\n'.format(time.time() - self.lastend))
+        if reuse:
+            R.record_log('camera settings and boxes of the last session\n')
+            R.record_log('binarization threshold: {}\n'.format(R.threshold))
+            R.set_boxes(*self.last['boxes'])
+        else:
+            R.set_camera()
+            R.set_area()
+        R.habituation()
+        R.tracking()
+        self.lastend = time.time()
+        self.last = {'threshold': R.threshold, 'brightness': R.camera.brightness, 'contrast': R.camera.contrast
+                     , 'boxes': R.rawboxes}
+        R.location.close()
+        R.log.close()
+        p = self.context.Process(target=RPP.save_session, args=(R.save_settings(), None))
+        p.start()
+        self.saving.append((args.animalID, p))
+
+    def serve(self):
+        '''run queued sessions until a stop request'''
+        sys.stderr.write('waiting for sessions on {}\n'.format(self.server.path))
+        while True:
+            job = self.server.jobs.get()
+            if job is None:
+                break
+            args, reuse = job
+            self.current = args.animalID
+            try:
+                self.run_session(args, reuse)
+            except Exception:
+                sys.stderr.write('session {} failed\n'.format(args.animalID))
+                traceback.print_exc()
+                # the triggers stay open for the next session: leave them off
+                for trigger in self.triggers.values():
+                    trigger.off()
+                if self.session is not None:
+                    self.session.stimulator.close()
+                    self.session.location.close()
+                    self.session.log.close()
+            self.current = None
+            self.session = None
+            self.saving = [(animalID, p) for animalID, p in self.saving if p.is_alive()]
+        self.server.close()
+        for animalID, p in self.saving:
+            sys.stderr.write('waiting for the data of {}\n'.format(animalID))
+            p.join()
+        for trigger in self.triggers.values():
+            trigger.close()
+        self.camera.close()
+
+def request(path, message):
+    '''send one request to the daemon and return its answer'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    f = sock.makefile('rw')
+    f.write(json.dumps(message) + '\n')
+    f.flush()
+    answer = json.loads(f.readline())
+    f.close()
+    sock.close()
+    return answer
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-S', '--socket', type=str, default='/tmp/rpp.sock'
+                        , help='unix socket of the daemon(default: /tmp/rpp.sock)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('serve', help='start the daemon')
+    submit = subparsers.add_parser('submit', help='queue a session')
+    submit.add_argument('--reuse', action='store_true'
+                        , help='skip camera and box setting: use those of the last session')
+    submit.add_argument('options', nargs=argparse.REMAINDER
+                        , help='animal ID and RPP.py options, e.g. A1 -s 10 --headless')
+    subparsers.add_parser('status', help='show the current session, queued sessions and sessions being saved')
+    subparsers.add_parser('stop', help='stop the daemon after the queued sessions')
+    args = parser.parse_args()
+    if args.command == 'serve':
+        RigDaemon(args.socket).serve()
+    elif args.command == 'submit':
+        sys.stdout.write(json.dumps(request(args.socket, {'args': args.options, 'reuse': args.reuse})) + '\n')
+    else:
+        sys.stdout.write(json.dumps(request(args.socket, {'command': args.command})) + '\n')
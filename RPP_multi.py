@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+'''real time place preference test in several arenas seen by one camera.
+   frames are captured once as YUV420 into a shared-memory ring; each arena is tracked in
+   its own process with its own boxes, GPIO pin, schedule and output directory'''
+
+import os
+import sys
+import time
+import json
+import datetime
+import signal
+import argparse
+import functools
+import multiprocessing
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+import RPP
+
+def select_box(image, title):
+    '''let the operator drag a box and return it as [x1, y1, x2, y2]'''
+    x, y, w, h = cv2.selectROI(title, image, showCrosshair=False)
+    return [int(x), int(y), int(x + w), int(y + h)]
+
+def define_arenas(image, animalIDs, pins):
+    '''draw the field and the two boxes of each arena on image. return the arena list'''
+    arenas = []
+    for animalID, pin in zip(animalIDs, pins):
+        arena = {'animalID': animalID, 'pin': pin}
+        for i, name in enumerate(['field', '1st box', '2nd box']):
+            arena['box{}'.format(i)] = select_box(image, '{}: {} (enter to accept)'.format(animalID, name))
+            cv2.destroyAllWindows()
+        arenas.append(arena)
+    return arenas
+
+def arena_worker(arena, settings, shmname, shape, size, nslots, jobs, done, finished, index, bgname, bgshape, ready):
+    '''track one arena: read frames from the shared ring, run RPP.process_frame on them,
+       drive the arena's own trigger and write its own log and location files.
+       bgname and bgshape give the shared block of gray habituation frames for the background model.
+       ready is released once the arena can take frames'''
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the main process handles quitting
+    shm = shared_memory.SharedMemory(name=shmname)
+    frames = np.ndarray((nslots,) + shape, dtype=np.uint8, buffer=shm.buf)
+    togray = functools.partial(RPP.yuv_gray, width=size[0], height=size[1])
+    tocolor = functools.partial(RPP.yuv_color, width=size[0], height=size[1])
+    keywords = dict(settings)
+    keywords.update({k: v for k, v in arena.items() if k not in ('animalID', 'box0', 'box1', 'box2')})
+    sessionlength = keywords.pop('sessionlength', 10)
+    noalternate = keywords.pop('noalternate', False)
+    # frames are shared with the other arenas and the recording, so nothing is drawn on them
+    R = RPP.RPP(arena['animalID'], sessionlength, noalternate, camera=RPP.SimulatedCamera(), stimthread=True
+                , annotate=False, **keywords)
+    os.rmdir(R.imagedirpath)
+    R.initial_log()
+    R.record_log('arena {} of a multi-arena session\n'.format(index))
+    R.record_log('binarization threshold: {}\n'.format(R.threshold))
+    R.set_boxes(arena['box0'], arena['box1'], arena['box2'])
+    # without habituation samples the background comes from the first tracked frame, as in RPP
+    if R.tracker != 'threshold' and bgshape[0] > 0:
+        bgshm = shared_memory.SharedMemory(name=bgname)
+        samples = np.ndarray(bgshape, dtype=np.uint8, buffer=bgshm.buf)
+        for sample in samples:
+            R.add_background_sample(sample)
+        del samples
+        bgshm.close()
+        R.build_background()
+    ready.release()
+    R.record_log('session start:{}\n'.format(datetime.datetime.now()))
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        frameno, slot, t = job
+        if frameno == 0:
+            R.stimulator.starttime = time.time() - t
+        if not finished[index]:
+            if R.process_frame(RPP.CapturedFrame(frames[slot], togray, tocolor, t), t) is None:
+                finished[index] = 1
+        done[index] = frameno
+    R.record_log('session end:{}\n'.format(datetime.datetime.now()))
+    R.record_log('frames: {}\n'.format(len(R.location)))
+    R.stimulator.close()
+    R.record_log('stimulation pulses: {}\n'.format(R.stimulator.pulses))
+    R.save_location()
+    R.trigger.close()
+    R.log.close()
+    del frames
+    shm.close()
+
+class MultiArena(object):
+    '''captures frames once and hands them to one tracking process per arena'''
+    def __init__(self, arenas, settings, nslots=8, dirpath='./'):
+        self.arenas = arenas
+        self.settings = settings
+        self.nslots = nslots
+        self.camera = RPP.PiCamera()
+        self.camera.resolution = settings.get('resolution', (704, 350))
+        self.camera.framerate = settings.get('framerate', 10)
+        self.framerate = float(self.camera.framerate)
+        self.source = RPP.PiCameraSource(self.camera)
+        self.dirpath = os.path.join(dirpath, 'multi-' + datetime.datetime.now().strftime('%Y%m%d%H%M'))
+        os.mkdir(self.dirpath)
+        self.dropped = 0
+        self.backgroundsamples = [] # gray frames taken once a second during habituation, the last 120
+
+    def first_frame(self):
+        frames = self.source.frames()
+        image = next(frames).color()
+        frames.close()
+        return image
+
+    def habituation(self, minutes):
+        '''show the live view for the adaptation time, "q" to skip. frames are sampled for
+           the background models of the arenas, as in RPP.habituation'''
+        s = time.time()
+        lastsample = 0
+        frames = self.source.frames()
+        for frame in frames:
+            if time.time() - lastsample >= 1:
+                self.backgroundsamples.append(frame.gray.copy())
+                if len(self.backgroundsamples) > 120:
+                    self.backgroundsamples.pop(0)
+                lastsample = time.time()
+            remain = minutes * 60 - (time.time() - s)
+            if cv2.waitKey(1)&0xFF == ord('q') or remain <= 0:
+                break
+            image = frame.color()
+            RPP.outline_text(image, 'adaptation: {} sec left. "q" for quiting adaptation'.format(int(remain))
+                             , (30, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (20, 20, 20), 2)
+            cv2.imshow('live', image)
+        frames.close()
+        cv2.destroyAllWindows()
+
+    def tracking(self):
+        '''run the session. the shared ring holds YUV420 frames in the layout of the frame source'''
+        shape = self.source.ring[0].shape
+        size = (self.source.width, self.source.height)
+        shm = shared_memory.SharedMemory(create=True, size=self.nslots * self.source.framesize)
+        ring = np.ndarray((self.nslots,) + shape, dtype=np.uint8, buffer=shm.buf)
+        bgshape = (len(self.backgroundsamples), self.source.height, self.source.width)
+        bgshm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(bgshape))))
+        if self.backgroundsamples:
+            np.ndarray(bgshape, dtype=np.uint8, buffer=bgshm.buf)[:] = np.stack(self.backgroundsamples)
+        self.backgroundsamples = []
+        context = multiprocessing.get_context('spawn')
+        done = context.Array('q', [-1] * len(self.arenas), lock=False) # last frame each arena finished
+        finished = context.Array('b', [0] * len(self.arenas), lock=False) # arena session is over
+        ready = context.Semaphore(0) # released by each arena once it can take frames
+        queues = [context.Queue() for arena in self.arenas]
+        workers = [context.Process(target=arena_worker, args=(arena, self.settings, shm.name, shape, size, self.nslots
+                                                              , queues[i], done, finished, i, bgshm.name, bgshape, ready))
+                   for i, arena in enumerate(self.arenas)]
+        for worker in workers:
+            worker.start()
+        # the session starts when every arena has started up and built its background model
+        for worker in workers:
+            while not ready.acquire(timeout=1):
+                if not all(w.is_alive() for w in workers):
+                    raise RuntimeError('an arena process ended before the session start')
+        framestore = RPP.FrameStore(os.path.join(self.dirpath, 'frames'))
+        encoder = RPP.EncoderPool(lambda tag, encimg: framestore.append(encimg, *tag))
+        frameno = 0
+        sessionst = time.time()
+        frames = self.source.frames()
+        for frame in frames:
+            current_time = frame.time - sessionst
+            if cv2.waitKey(1)&0xFF == ord('q') or all(finished):
+                break
+            slot = frameno % self.nslots
+            # the slot still holds frame frameno - nslots until every arena is done with it
+            if min(done) < frameno - self.nslots:
+                self.dropped += 1
+            else:
+                ring[slot] = frame.slot
+                encoder.submit(frame, (frameno, current_time, 0))
+                for q in queues:
+                    q.put((frameno, slot, current_time))
+                frameno += 1
+            cv2.imshow('live', frame.color())
+            encoder.drain()
+        frames.close()
+        cv2.destroyAllWindows()
+        for q in queues:
+            q.put(None)
+        for worker in workers:
+            worker.join()
+        encoder.close()
+        framestore.close()
+        self.camera.close()
+        del ring
+        shm.close()
+        shm.unlink()
+        bgshm.close()
+        bgshm.unlink()
+        self.dropped += self.source.dropped
+        sys.stdout.write('frames: {}, dropped: {}, dropped by encoder: {}, failed to encode: {}\n'.format(
+            frameno, self.dropped, encoder.dropped, encoder.failed))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('arenas', type=str
+                        , help='JSON file with a list of arenas: animalID, pin, box0, box1, box2 ([x1, y1, x2, y2]) and any RPP option')
+    parser.add_argument('--define', type=str, nargs='+', metavar='ANIMALID:PIN', default=None
+                        , help='draw the boxes of these arenas and save them to the arenas file before the session')
+    parser.add_argument('-d', '--dir', type=str, default='./', help='data directory')
+    parser.add_argument('-s', '--session', type=int, default=10
+                        , help='length of each session in minutes(default:10)')
+    parser.add_argument('-n', '--noalternate', action='store_true'
+                        , help='not switching stimulation room in the second half (default: alternating)')
+    parser.add_argument('-a', '--adaptation', type=int, default=20
+                        , help="time for adaptation (default: 20)")
+    parser.add_argument('-b', '--pre_session', type=int, default=10
+                        , help='minutes before session start(default=10)')
+    parser.add_argument('-B', '--breaktime',  type=int, default=0
+                        , help='break length in min between session 1 and 2(default:0)')
+    parser.add_argument('-x', '--xresolution', type=int, default=704
+                        , help='video resolution, x axis(default:704)')
+    parser.add_argument('-y', '--yresolution', type=int, default=400
+                        , help='video resolution, y axis(default:400)')
+    parser.add_argument('-f', '--framerate', type=int, default=10
+                        , help='video framerate(fps, default:10)')
+    parser.add_argument('-t', '--threshold', type=int, default=30
+                        , help='threshold for binarizing images(default:30)')
+    args = parser.parse_args()
+    settings = {'dir': args.dir, 'sessionlength': args.session, 'noalternate': args.noalternate
+                , 'pre_session': args.pre_session, 'breaktime': args.breaktime, 'adaptation': args.adaptation
+                , 'resolution': (args.xresolution, args.yresolution), 'framerate': args.framerate
+                , 'threshold': args.threshold}
+    M = MultiArena([], settings, dirpath=args.dir)
+    image = M.first_frame()
+    if args.define:
+        animalIDs = [d.split(':')[0] for d in args.define]
+        pins = [int(d.split(':')[1]) for d in args.define]
+        outf = open(args.arenas, 'w')
+        json.dump(define_arenas(image, animalIDs, pins), outf, indent=1)
+        outf.close()
+    M.arenas = json.load(open(args.arenas))
+    cv2.imwrite(os.path.join(M.dirpath, 'arenas.jpg'), image, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
+    M.habituation(args.adaptation)
+    M.tracking()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+'''replay recorded RPP sessions through the tracking and laser logic without a Pi'''
+
+import os
+import re
+import sys
+import json
+import shutil
+import time
+import datetime
+import argparse
+import tarfile
+import zipfile
+import tempfile
+import fractions
+import functools
+import concurrent.futures
+import cv2
+import numpy as np
+import RPP
+
+class FakeTrigger(object):
+    '''stands in for gpiozero.LED and records every change of its state.
+       now is set by the replay loop to the session time of the current frame'''
+    def __init__(self):
+        self.value = 0
+        self.now = 0.0
+        self.edges = [] # (session time, new value)
+
+    def _set(self, value):
+        if value != self.value:
+            self.edges.append((self.now, value))
+        self.value = value
+
+    def on(self):
+        self._set(1)
+
+    def off(self):
+        self._set(0)
+
+    def blink(self, on_time=1, off_time=1):
+        self._set(1)
+
+    def close(self):
+        self.off()
+
+# settings written by RPP.initial_log, set_camera and set_area
+LOG_PATTERNS = [('pre_session', re.compile(r'pre_session: (\d+) min'), int)
+                , ('sessionlength', re.compile(r'session length: (\d+) min'), int)
+                , ('breaktime', re.compile(r'break between session: (\d+) min'), int)
+                , ('framerate', re.compile(r'video frame rate: ([\d./]+) fps'), lambda v: float(fractions.Fraction(v)))
+                , ('pulselength', re.compile(r'stimulation pulse length: ([\d.]+) ms'), float)
+                , ('frequency', re.compile(r'stimulation frequency: ([\d.]+) Hz'), float)
+                , ('threshold', re.compile(r'binarization threshold: (\d+)'), int)
+                , ('searchwindow', re.compile(r'search window: (\d+) px'), int)]
+SIDE_PATTERN = re.compile(r'activated (side: |alternatively\. first side:)(right|left)')
+STIMULATION_PATTERN = re.compile(r'stimulation hysteresis: (\d+) px, minimum dwell: ([\d.]+) s')
+TRACKER_PATTERN = re.compile(r'tracker: (\w+), scale ([\d.]+), difference (\d+), minimum area (\d+) px')
+RESOLUTION_PATTERN = re.compile(r'video resolution: (\d+) x (\d+)')
+BOX_PATTERN = re.compile(r'box([012]): \((-?\d+), (-?\d+)\) x \((-?\d+), (-?\d+)\)')
+PREDICT_PATTERN = re.compile(r'prediction: lead ([\d.]+) s, bridged misses (\d+)')
+ZONE_PATTERN = re.compile(r'zone(\d+): (\{.*\})')
+ZONE_MODE_PATTERN = re.compile(r'zones: (custom|boxes)$')
+
+def read_session_log(logpath):
+    '''return RPP keywords and raw box cordinates found in the log.txt of a session'''
+    settings = {}
+    boxes = {}
+    zones = {}
+    zonemode = None
+    for l in open(logpath):
+        for key, pattern, convert in LOG_PATTERNS:
+            m = pattern.match(l)
+            if m:
+                settings[key] = convert(m.group(1))
+        m = SIDE_PATTERN.match(l)
+        if m:
+            settings['noalternate'] = m.group(1) == 'side: '
+            settings['right_first'] = m.group(2) == 'right'
+        m = STIMULATION_PATTERN.match(l)
+        if m:
+            settings['hysteresis'] = int(m.group(1))
+            settings['mindwell'] = float(m.group(2))
+        m = TRACKER_PATTERN.match(l)
+        if m:
+            settings['tracker'] = m.group(1)
+            settings['scale'] = float(m.group(2))
+            settings['difference'] = int(m.group(3))
+            settings['minarea'] = int(m.group(4))
+        m = RESOLUTION_PATTERN.match(l)
+        if m:
+            settings['resolution'] = (int(m.group(1)), int(m.group(2)))
+        m = BOX_PATTERN.match(l)
+        if m:
+            boxes[int(m.group(1))] = [int(v) for v in m.groups()[1:]]
+        m = PREDICT_PATTERN.match(l)
+        if m:
+            settings['predict'] = float(m.group(1))
+            settings['maxmisses'] = int(m.group(2))
+        m = ZONE_PATTERN.match(l)
+        if m:
+            zones[int(m.group(1))] = json.loads(m.group(2))
+        m = ZONE_MODE_PATTERN.match(l)
+        if m:
+            zonemode = m.group(1)
+    if zonemode is None: # logs without the marker: custom zones are told apart from box1 and box2 by their shapes
+        custom = len(zones) > 2 or any(zone['shape'] != 'box' for zone in zones.values())
+    else:
+        custom = zonemode == 'custom'
+    if custom and zones:
+        settings['zones'] = [zones[i] for i in sorted(zones)]
+    return settings, boxes
+
+def read_location_times(sessiondir):
+    '''return recorded times by frame number from location.bin or location.txt, or None'''
+    locationpath = os.path.join(sessiondir, 'location.bin')
+    if os.path.exists(locationpath):
+        return RPP.load_location(locationpath)['time']
+    locationpath = os.path.join(sessiondir, 'location.txt')
+    if not os.path.exists(locationpath):
+        return None
+    inf = open(locationpath)
+    column = inf.readline().rstrip('\n').split('\t').index('time')
+    times = [float(l.rstrip('\n').split('\t')[column]) for l in inf]
+    inf.close()
+    return times
+
+def read_positions(sessiondir):
+    '''return x, y and detected arrays of the tracked positions from location.bin or location.txt'''
+    locationpath = os.path.join(sessiondir, 'location.bin')
+    if os.path.exists(locationpath):
+        data = RPP.load_location(locationpath)
+        return data['x'], data['y'], data['zone'] >= 0
+    inf = open(os.path.join(sessiondir, 'location.txt'))
+    header = inf.readline().rstrip('\n').split('\t')
+    rows = [l.rstrip('\n').split('\t') for l in inf]
+    inf.close()
+    x = np.array([int(row[header.index('x')]) for row in rows])
+    y = np.array([int(row[header.index('y')]) for row in rows])
+    detected = np.array([row[header.index('in_box1')] != 'nan' for row in rows], dtype=bool)
+    return x, y, detected
+
+def session_zonemap(sessiondir, zones=None):
+    '''return an RPP.ZoneMap of the field of a session for zones, by default the zones
+       (or box1 and box2) recorded in log.txt'''
+    settings, boxes = read_session_log(os.path.join(sessiondir, 'log.txt'))
+    if zones is None:
+        zones = settings.get('zones') or [{'shape': 'box', 'box': boxes[i]} for i in [1, 2]]
+    x1, y1, x2, y2 = boxes[0]
+    xmin, xmax = sorted([max(0, x1), max(0, x2)])
+    ymin, ymax = sorted([max(0, y1), max(0, y2)])
+    if 'resolution' in settings:
+        xmax = min(xmax, settings['resolution'][0])
+        ymax = min(ymax, settings['resolution'][1])
+    return RPP.ZoneMap((ymax - ymin, xmax - xmin), zones, (xmin, ymin))
+
+def rezone_session(sessiondir, zones, outname='zones.txt'):
+    '''label the recorded positions of a session with new zones (see RPP.draw_zone)
+       without replaying its frames. zone ids by frame go to outname in sessiondir.
+       return the zone ids'''
+    x, y, detected = read_positions(sessiondir)
+    zoneids = session_zonemap(sessiondir, zones).lookup(x, y, detected)
+    outf = open(os.path.join(sessiondir, outname), 'w')
+    outf.write('frame\tzone\n')
+    for frameno, zone in enumerate(zoneids.tolist()):
+        outf.write('{}\t{}\n'.format(frameno, zone))
+    outf.close()
+    return zoneids
+
+def frame_number(name):
+    '''return N for a member named .../N.jpg, None for other members'''
+    m = re.search(r'(?:^|/)(\d+)\.jpg$', name)
+    return int(m.group(1)) if m else None
+
+# recordings in the order they are looked for
+RECORDINGS = [os.path.join('frames', 'index.bin'), 'images.tar', 'images.zip', 'images.tar.gz'
+              , 'video.avi', 'video.mp4']
+
+def find_recording(sessiondir):
+    '''return the path of the recorded frames of a session'''
+    for name in RECORDINGS:
+        path = os.path.join(sessiondir, name)
+        if os.path.exists(path):
+            return path
+    raise IOError('no recorded frames in {}'.format(sessiondir))
+
+def iter_encoded_frames(path):
+    '''yield (frame number, JPEG bytes, time or None) from an image archive, in order'''
+    if path.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        members = {frame_number(n): n for n in archive.namelist() if frame_number(n) is not None}
+        for frameno in sorted(members):
+            yield frameno, archive.read(members[frameno]), None
+        archive.close()
+    elif path.endswith('.tar'):
+        archive = tarfile.open(path)
+        members = {frame_number(m.name): m for m in archive.getmembers() if frame_number(m.name) is not None}
+        for frameno in sorted(members):
+            yield frameno, archive.extractfile(members[frameno]).read(), None
+        archive.close()
+    else:
+        # members of images.tar.gz are not in frame order and seeking back in
+        # a gzip stream decompresses it again, so the frames are extracted once
+        # to a temporary directory and read from there in order
+        tempdir = tempfile.mkdtemp(prefix='replay-')
+        try:
+            archive = tarfile.open(path, 'r|gz')
+            members = {}
+            for m in archive:
+                if frame_number(m.name) is not None:
+                    members[frame_number(m.name)] = os.path.join(tempdir, '{}.jpg'.format(frame_number(m.name)))
+                    with open(members[frame_number(m.name)], 'wb') as outf:
+                        shutil.copyfileobj(archive.extractfile(m), outf)
+            archive.close()
+            for frameno in sorted(members):
+                with open(members[frameno], 'rb') as inf:
+                    encimg = inf.read()
+                os.remove(members[frameno])
+                yield frameno, encimg, None
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+def iter_frames(sessiondir, framerate):
+    '''yield (frame number, BGR image, session time) from the recording of a session'''
+    times = read_location_times(sessiondir)
+    def frame_time(frameno, t):
+        if t is not None:
+            return t
+        if times is not None and frameno < len(times):
+            return times[frameno]
+        return frameno / framerate
+    path = find_recording(sessiondir)
+    if path.endswith('index.bin'):
+        # frames of any recording mode, rebuilt to full frames
+        frames = RPP.RecordingReader(os.path.dirname(path))
+        for record, image in frames:
+            yield int(record['frame']), image, float(record['time'])
+        frames.close()
+    elif path.endswith(('.avi', '.mp4')):
+        cap = cv2.VideoCapture(path)
+        frameno = 0
+        while True:
+            ret, image = cap.read()
+            if not ret:
+                break
+            if path.endswith('.avi'):
+                # video.avi from RPP.write_mjpeg_avi places frames by time from the first frame
+                t = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000 + (times[0] if times is not None and len(times) else 0)
+            else:
+                t = None # video.mp4 of older versions has one frame per row of location.txt
+            yield frameno, image, frame_time(frameno, t)
+            frameno += 1
+        cap.release()
+    else:
+        for frameno, encimg, t in iter_encoded_frames(path):
+            image = cv2.imdecode(np.frombuffer(encimg, dtype=np.uint8), 1)
+            yield frameno, image, frame_time(frameno, t)
+
+def replay_session(sessiondir, outname=None, boxes=None, **overrides):
+    '''run tracking and laser logic over a recorded session as fast as possible.
+       results go to a new directory in sessiondir. overrides replace RPP keywords
+       read from log.txt and boxes replaces {0: box0, 1: box1, 2: box2}.
+       return a summary dict'''
+    settings, loggedboxes = read_session_log(os.path.join(sessiondir, 'log.txt'))
+    settings.update(overrides)
+    loggedboxes.update(boxes or {})
+    if outname is None:
+        outname = 'replay-' + datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    sessionlength = settings.pop('sessionlength', 10)
+    noalternate = settings.pop('noalternate', False)
+    animalID = os.path.basename(os.path.normpath(sessiondir))
+    trigger = FakeTrigger()
+    R = RPP.RPP(animalID, sessionlength, noalternate, camera=RPP.SimulatedCamera(), trigger=trigger
+                , dirpath=os.path.join(sessiondir, outname), **settings)
+    os.rmdir(R.imagedirpath)
+    R.initial_log()
+    R.record_log('replay of {}\n'.format(os.path.abspath(sessiondir)))
+    R.record_log('binarization threshold: {}\n'.format(R.threshold))
+    R.set_boxes(loggedboxes[0], loggedboxes[1], loggedboxes[2])
+    if R.tracker != 'threshold':
+        # habituation is not recorded: sample the first minute once per second instead
+        for frameno, image, t in iter_frames(sessiondir, R.framerate):
+            if t > 60:
+                break
+            if frameno % max(1, int(R.framerate)) == 0:
+                R.add_background_sample(image)
+        R.build_background()
+    s = time.time()
+    for frameno, image, t in iter_frames(sessiondir, R.framerate):
+        trigger.now = t
+        if R.process_frame(image, t) is None:
+            break
+    elapsed = time.time() - s
+    R.stimulator.close()
+    R.save_location()
+    outf = open(os.path.join(R.dirpath, 'trigger.txt'), 'w')
+    outf.write('time\tvalue\n')
+    for t, value in trigger.edges:
+        outf.write('{}\t{}\n'.format(t, value))
+    outf.close()
+    data = RPP.load_location(R.location.path)
+    summary = {'session': sessiondir, 'output': R.dirpath, 'frames': len(data)
+               , 'detected': int(np.sum(data['zone'] >= 0)), 'stimulated': int(np.sum(data['stimulation']))
+               , 'seconds': elapsed, 'fps': len(data) / elapsed if elapsed else 0}
+    R.record_log('replay: {frames} frames, {detected} detected, {stimulated} stimulated'
+                 ', {seconds:.1f} s ({fps:.1f} fps)\n'.format(**summary))
+    R.log.close()
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sessiondirs', type=str, nargs='+', help='session directories recorded by RPP.py')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count()
+                        , help='sessions replayed in parallel(default: number of cores)')
+    parser.add_argument('-o', '--outname', type=str, default=None
+                        , help='name of the result directory in each session(default: replay-[date])')
+    parser.add_argument('-t', '--threshold', type=int, default=None
+                        , help='threshold for binarizing images(default: as recorded)')
+    parser.add_argument('-w', '--searchwindow', type=int, default=None
+                        , help='half size of the search window in pixels(default: as recorded)')
+    parser.add_argument('--tracker', choices=['threshold', 'median', 'average'], default=None
+                        , help='tracking method(default: as recorded)')
+    parser.add_argument('--hysteresis', type=int, default=None
+                        , help='stimulation exit margin in pixels(default: as recorded)')
+    parser.add_argument('--mindwell', type=float, default=None
+                        , help='seconds in the box before stimulation starts(default: as recorded)')
+    for i in range(3):
+        parser.add_argument('--box{}'.format(i), type=int, nargs=4, default=None, metavar=('X1', 'Y1', 'X2', 'Y2')
+                            , help='camera cordinates of box{}(default: as recorded)'.format(i))
+    parser.add_argument('--predict', type=float, default=None
+                        , help='seconds ahead to predict positions for the laser decision(default: as recorded)')
+    parser.add_argument('--zones', type=str, default=None
+                        , help='JSON file with zones as for RPP.py --zones(default: as recorded)')
+    parser.add_argument('--rezone', action='store_true'
+                        , help='only label the recorded positions with --zones into zones.txt, without replaying frames')
+    args = parser.parse_args()
+    if args.rezone:
+        if not args.zones:
+            parser.error('--rezone needs --zones')
+        zones = json.load(open(args.zones))
+        for sessiondir in args.sessiondirs:
+            zoneids = rezone_session(sessiondir, zones)
+            counts = np.bincount(zoneids[zoneids >= 0], minlength=len(zones) + 1)
+            sys.stderr.write('{}\t{}\n'.format(sessiondir, '\t'.join(
+                'zone{}: {}'.format(i, n) for i, n in enumerate(counts.tolist()))))
+        sys.exit(0)
+    overrides = {k: getattr(args, k) for k in ['threshold', 'searchwindow', 'hysteresis', 'mindwell', 'tracker', 'predict'] if getattr(args, k) is not None}
+    if args.zones:
+        overrides['zones'] = json.load(open(args.zones))
+    boxes = {i: getattr(args, 'box{}'.format(i)) for i in range(3) if getattr(args, 'box{}'.format(i))}
+    run = functools.partial(replay_session, outname=args.outname, boxes=boxes, **overrides)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for summary in pool.map(run, args.sessiondirs):
+            sys.stderr.write('{session}\t{frames} frames\t{detected} detected\t{stimulated} stimulated'
+                             '\t{fps:.1f} fps\n'.format(**summary))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+'''statistics of recorded RPP sessions: time in zones, zone entries, distance travelled
+   and stimulation duty cycle by period'''
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import concurrent.futures
+import numpy as np
+import RPP
+import RPP_replay
+
+STATS_VERSION = 1 # cached results of other versions are not used
+
+def find_sessions(paths):
+    '''return the directories with location.bin or location.txt in paths'''
+    sessions = []
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            if 'location.bin' in files or 'location.txt' in files:
+                sessions.append(root)
+    return sessions
+
+def location_path(sessiondir):
+    '''return location.bin of a session, or location.txt of older versions'''
+    path = os.path.join(sessiondir, 'location.bin')
+    if os.path.exists(path):
+        return path
+    return os.path.join(sessiondir, 'location.txt')
+
+def cache_key(sessiondir):
+    '''return a hash of the location and log files of a session'''
+    h = hashlib.sha1('stats {}'.format(STATS_VERSION).encode())
+    for path in [location_path(sessiondir), os.path.join(sessiondir, 'log.txt')]:
+        if not os.path.exists(path):
+            continue
+        inf = open(path, 'rb')
+        for block in iter(lambda: inf.read(2**20), b''):
+            h.update(block)
+        inf.close()
+    return h.hexdigest()
+
+def load_session(sessiondir):
+    '''return period, x, y, zone, stimulation and time arrays of a session.
+       x and y are NaN and zone is -1 where the animal was not detected.
+       location.txt without a zone column is labelled with the boxes in log.txt'''
+    path = location_path(sessiondir)
+    if path.endswith('.bin'):
+        data = RPP.load_location(path)
+        period, x, y = data['period'].astype(np.int64), data['x'].astype(np.float64), data['y'].astype(np.float64)
+        zone, stimulation, t = data['zone'].astype(np.int64), data['stimulation'] > 0, data['time']
+    else:
+        inf = open(path)
+        header = inf.readline().rstrip('\n').split('\t')
+        rows = [l.rstrip('\n').split('\t') for l in inf if l.strip()]
+        inf.close()
+        column = lambda name, convert: np.array([convert(row[header.index(name)]) for row in rows])
+        period, x, y = column('period', int), column('x', float), column('y', float)
+        stimulation, t = column('stimulation', float) > 0, column('time', float)
+        detected = column('in_box1', str) != 'nan'
+        if 'zone' in header:
+            zone = column('zone', int)
+        else:
+            try:
+                zone = RPP_replay.session_zonemap(sessiondir).lookup(x, y, detected).astype(np.int64)
+            except (IOError, KeyError): # no boxes in log.txt: only box1 is known
+                zone = np.where(detected, (column('in_box1', str) == 'True').astype(np.int64), -1)
+    x = np.where(zone >= 0, x, np.nan)
+    y = np.where(zone >= 0, y, np.nan)
+    return period.reshape(-1), x, y, zone.reshape(-1), stimulation, np.asarray(t, dtype=np.float64)
+
+def session_stats(period, x, y, zone, stimulation, t):
+    '''per-period statistics of one session from arrays by frame (see load_session).
+       every frame lasts until the next one, the last one the median frame interval.
+       distance bridges undetected frames; entries count changes of the zone between
+       detected frames. return a list of dicts, one per period'''
+    if len(t) == 0:
+        return []
+    dt = np.empty(len(t))
+    dt[:-1] = np.diff(t)
+    dt[-1] = np.median(dt[:-1]) if len(t) > 1 else 0
+    nperiods = int(period.max()) + 1
+    nzones = int(max(zone.max(), 0)) + 1 # zone 0 is outside of all zones
+    # seconds by period and zone, column 0 for undetected frames
+    seconds = np.bincount(period * (nzones + 1) + zone + 1, weights=dt
+                          , minlength=nperiods * (nzones + 1)).reshape(nperiods, nzones + 1)
+    frames = np.bincount(period, minlength=nperiods)
+    detected = zone >= 0
+    stimseconds = np.bincount(period, weights=dt * stimulation, minlength=nperiods)
+    dperiod, dzone = period[detected], zone[detected]
+    steps = np.hypot(np.diff(x[detected]), np.diff(y[detected]))
+    distance = np.bincount(dperiod[1:], weights=steps, minlength=nperiods)
+    entered = np.nonzero(dzone[1:] != dzone[:-1])[0] + 1
+    entries = np.bincount(dperiod[entered] * nzones + dzone[entered]
+                          , minlength=nperiods * nzones).reshape(nperiods, nzones)
+    total = seconds.sum(axis=1)
+    stats = []
+    for p in range(nperiods):
+        if frames[p] == 0:
+            continue
+        stats.append({'period': p, 'frames': int(frames[p])
+                      , 'detected': int(np.sum(detected & (period == p))), 'seconds': float(total[p])
+                      , 'undetected_seconds': float(seconds[p, 0]), 'zone_seconds': seconds[p, 1:].tolist()
+                      , 'zone_entries': entries[p].tolist(), 'distance': float(distance[p])
+                      , 'stimulation_seconds': float(stimseconds[p])
+                      , 'duty_cycle': float(stimseconds[p] / total[p]) if total[p] > 0 else float('nan')})
+    return stats
+
+def process_session(sessiondir):
+    '''load a session and return its statistics'''
+    return session_stats(*load_session(sessiondir))
+
+def cached_stats(sessions, cachedir, jobs):
+    '''return the statistics of each session. results are kept in cachedir by the hash
+       of the session files, so only new or changed sessions are processed'''
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    keys = [cache_key(s) for s in sessions]
+    results = {}
+    todo = []
+    for sessiondir, key in zip(sessions, keys):
+        cachepath = os.path.join(cachedir, key + '.json')
+        if os.path.exists(cachepath):
+            results[key] = json.load(open(cachepath))
+        elif key not in results:
+            results[key] = None
+            todo.append((sessiondir, key))
+    sys.stderr.write('{} sessions, {} cached\n'.format(len(sessions), len(sessions) - len(todo)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        for (sessiondir, key), stats in zip(todo, pool.map(process_session, [s for s, k in todo])):
+            cachepath = os.path.join(cachedir, key + '.json')
+            outf = open(cachepath + '.tmp', 'w')
+            json.dump(stats, outf)
+            outf.close()
+            os.replace(cachepath + '.tmp', cachepath)
+            results[key] = stats
+    return [results[key] for key in keys]
+
+def write_table(sessions, allstats, outf):
+    '''write one tab-separated row per session and period'''
+    nzones = max([len(s['zone_seconds']) for stats in allstats for s in stats] + [0])
+    columns = ['frames', 'detected', 'seconds', 'undetected_seconds', 'distance', 'stimulation_seconds', 'duty_cycle']
+    outf.write('\t'.join(['session', 'period'] + columns
+                         + ['zone{}_seconds'.format(i) for i in range(nzones)]
+                         + ['zone{}_entries'.format(i) for i in range(nzones)]) + '\n')
+    for sessiondir, stats in zip(sessions, allstats):
+        for s in stats:
+            zoneseconds = s['zone_seconds'] + [0] * (nzones - len(s['zone_seconds']))
+            zoneentries = s['zone_entries'] + [0] * (nzones - len(s['zone_entries']))
+            outf.write('\t'.join([sessiondir, str(s['period'])] + [str(s[c]) for c in columns]
+                                 + [str(v) for v in zoneseconds + zoneentries]) + '\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', type=str, nargs='+'
+                        , help='session directories, or directories searched for sessions')
+    parser.add_argument('-o', '--output', type=str, default=None
+                        , help='save the table to this file(default: stdout)')
+    parser.add_argument('-c', '--cache', type=str, default=os.path.join('.', '.rpp_stats')
+                        , help='directory for cached session results(default: ./.rpp_stats)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count()
+                        , help='sessions processed in parallel(default: number of cores)')
+    args = parser.parse_args()
+    sessions = find_sessions(args.paths)
+    allstats = cached_stats(sessions, args.cache, args.jobs)
+    outf = open(args.output, 'w') if args.output else sys.stdout
+    write_table(sessions, allstats, outf)
+    if args.output:
+        outf.close()
@@ -1,10 +1,24 @@
 import os, shutil
+import hashlib
+import zipfile
+import json
+import threading
 import os.path
 from ij import IJ, WindowManager
 from ij.plugin.frame import RoiManager
 from ij.measure import ResultsTable
 from ij.plugin.filter import ParticleAnalyzer, BackgroundSubtracter, EDM
-from ij.io import FileSaver
+from ij.io import FileSaver, RoiDecoder
+from ij import ImagePlus
+from ij.plugin import RGBStackMerge
+from ij.process import ImageProcessor, ByteProcessor, ImageStatistics, Blitter
+from ij.measure import Measurements
+from ij.gui import Overlay
+from java.awt import GraphicsEnvironment
+from java.lang import Runtime, Throwable, UnsupportedOperationException
+from java.io import IOException
+from java.nio.file import Files, Paths, StandardCopyOption
+from java.util.concurrent import Executors, Callable
 
 '''
 jython script for signal quantification of 3 ch + DAPI image  
@@ -21,6 +35,37 @@ MaskDir = os.path.join(ProcessedDir, "mask")
 ROIDir = os.path.join(ProcessedDir, "ROI")
 StatDir = os.path.join(ProcessedDir, "stat")
 CompositeDir = os.path.join(ProcessedDir, "composite")
+# batch mode: all samples without the controller, also used when Fiji runs headless
+BatchMode = False
+BatchThreads = Runtime.getRuntime().availableProcessors()
+AnalyzerLock = threading.Lock()
+# one tab separated line per sample: sample directory name, threshold of the blurred DAPI
+# image ("auto" or a number) and a saved region selection (.roi, empty for the whole image)
+BatchSettingsFile = os.path.join(ProcessedDir, "batch_settings.txt")
+BatchAutoThreshold = "Default" # auto threshold method for samples without a threshold
+BatchRedo = False # also samples already processed, e.g. after a parameter change (unchanged stages come from the cache)
+# stage parameters: DAPI background and blur, nucleus size and circularity, signal background
+DapiRolling = 40
+DapiSigma = 3
+MinSize, MaxSize = 500, 2500
+MinCircularity, MaxCircularity = 0.1, 1.0
+SignalRolling = 0.5
+# stage outputs (composite, mask, DAPI after background subtraction, ROI set, tables) by a hash
+# of their input files and parameters, so only stages whose inputs changed are computed again
+CacheDir = os.path.join(ProcessedDir, "cache")
+CacheLock = threading.Lock()
+Hashes = None
+# s0 copies only files that are new or changed since the last run (size and modification time)
+IngestManifest = os.path.join(ProcessedDir, "ingest_manifest.txt")
+IngestHash = False # also compare content hashes, so files touched without a change are not copied again
+# hard link instead of copying when TifDir is on the same file system. linked files are the
+# original data: saving a TifDir image in place in Fiji would overwrite the raw acquisition
+IngestLink = False
+IngestThreads = 4
+# outputs of each sample and the step reached with the open sample, replacing directory scans
+StateFile = os.path.join(ProcessedDir, "sample_state.json")
+StateLock = threading.Lock()
+State = None
 
 def closeWindowWitoutSave(title):
 	IJ.selectWindow(title)
@@ -34,11 +79,132 @@ def getWindowTitles():
 		titles.append(WindowManager.getImage(i).getTitle())
 	return titles
 
+def fileHash(path):
+	h = hashlib.sha1()
+	inf = open(path, "rb")
+	while True:
+		block = inf.read(1 << 20)
+		if not block:
+			break
+		h.update(block)
+	inf.close()
+	return h.hexdigest()
+
+def inputHash(path):
+	# content hash of an input file, remembered in CacheDir/hashes.txt by path, size and mtime
+	global Hashes
+	hashpath = os.path.join(CacheDir, "hashes.txt")
+	st = os.stat(path)
+	record = (path, st.st_size, st.st_mtime)
+	with CacheLock:
+		if Hashes is None:
+			Hashes = {}
+			if os.path.exists(hashpath):
+				for l in open(hashpath):
+					p, size, mtime, digest = l.rstrip("\n").split("\t")
+					Hashes[(p, int(size), float(mtime))] = digest
+		digest = Hashes.get(record)
+	if digest is None:
+		digest = fileHash(path)
+		with CacheLock:
+			Hashes[record] = digest
+			outf = open(hashpath, "a")
+			outf.write("\t".join([path, str(st.st_size), repr(st.st_mtime), digest]) + "\n")
+			outf.close()
+	return digest
+
+def cacheKey(stage, parameters, inputs):
+	# hash of a stage, its parameters and the hashes or cache keys of its inputs
+	h = hashlib.sha1()
+	h.update(stage + repr(parameters))
+	for key in inputs:
+		h.update(key)
+	return h.hexdigest()
+
+def cachePath(key, ext):
+	return os.path.join(CacheDir, key + ext)
+
+def storeFile(path, cachepath):
+	# outputs are copied, not linked: a later overwrite of an output must not change the cache
+	tmppath = cachepath + ".tmp"
+	Files.copy(Paths.get(path), Paths.get(tmppath), StandardCopyOption.REPLACE_EXISTING)
+	replaceFile(tmppath, cachepath)
+
+def exportFile(cachepath, path):
+	Files.copy(Paths.get(cachepath), Paths.get(path), StandardCopyOption.REPLACE_EXISTING)
+
+def channelPaths(SampleDirPath):
+	channels = {}
+	for f in sorted(os.listdir(SampleDirPath)):
+		for term in ["ch00", "ch01", "ch02", "ch03"]:
+			if f.endswith("tif") and term in f:
+				channels[term] = os.path.join(SampleDirPath, f)
+	return channels
+
+def compositeKey(SampleDirPath):
+	paths = channelPaths(SampleDirPath)
+	return cacheKey("composite", (), [inputHash(paths[ch]) for ch in sorted(paths)])
+
+def readManifest():
+	# copy path relative to TifDir -> [size, mtime, hash] of the original when it was copied
+	manifest = {}
+	if os.path.exists(IngestManifest):
+		for l in open(IngestManifest):
+			fields = l.rstrip("\n").split("\t")
+			manifest[fields[0]] = [int(fields[1]), float(fields[2]), fields[3]]
+	return manifest
+
+def writeManifest(manifest):
+	# written to a temporary file and moved, so an interrupted run keeps the old file
+	tmppath = IngestManifest + ".tmp"
+	outf = open(tmppath, "w")
+	for key in sorted(manifest):
+		size, mtime, digest = manifest[key]
+		outf.write("\t".join([key, str(size), repr(mtime), digest]) + "\n")
+	outf.close()
+	replaceFile(tmppath, IngestManifest)
+
+def replaceFile(tmppath, path):
+	Files.move(Paths.get(tmppath), Paths.get(path), StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE)
+
+def ingestFile(originalpath, copypath):
+	# hard link where the file system allows it, copy otherwise
+	if os.path.exists(copypath):
+		os.remove(copypath)
+	if IngestLink:
+		try:
+			Files.createLink(Paths.get(copypath), Paths.get(originalpath))
+			return "linked"
+		except (IOException, UnsupportedOperationException):
+			pass
+	Files.copy(Paths.get(originalpath), Paths.get(copypath), StandardCopyOption.COPY_ATTRIBUTES)
+	return "copied"
+
+class IngestTask(Callable):
+	def __init__(self, originalpath, copypath, key, record):
+		self.originalpath = originalpath
+		self.copypath = copypath
+		self.key = key
+		self.record = record
+
+	def call(self):
+		st = os.stat(self.originalpath)
+		digest = ""
+		if IngestHash:
+			digest = fileHash(self.originalpath)
+			if self.record is not None and self.record[2] == digest and os.path.exists(self.copypath):
+				return self.key, [st.st_size, st.st_mtime, digest], "unchanged"
+		return self.key, [st.st_size, st.st_mtime, digest], ingestFile(self.originalpath, self.copypath)
+
 def s0(): #file copy
-	for d in [OriginalDataDir, ProcessedDir, TifDir, MaskDir, ROIDir, StatDir, CompositeDir]:
+	for d in [OriginalDataDir, ProcessedDir, TifDir, MaskDir, ROIDir, StatDir, CompositeDir, CacheDir]:
 		if not os.path.exists(d):
 			os.mkdir(d)
 	
+	manifest = readManifest()
+	tasks = []
+	unchanged = 0
+	samples = set()
 	for r, d, files in os.walk(OriginalDataDir):
 		for f in files:
 			if f.endswith(".tif") and "Processed" in f and "ch0" in f:        	
@@ -48,35 +214,140 @@ def s0(): #file copy
 				if not os.path.exists(SampleDirPath):
 					os.mkdir(SampleDirPath)
 				copypath = os.path.join(SampleDirPath, f)
-				shutil.copy(originalpath, copypath)
+				key = os.path.join(SampleDirName, f)
+				samples.add(SampleDirName)
+				record = manifest.get(key)
+				st = os.stat(originalpath)
+				if record is not None and record[:2] == [st.st_size, st.st_mtime] and os.path.exists(copypath):
+					unchanged += 1
+					continue
+				tasks.append(IngestTask(originalpath, copypath, key, record))
+	addSamples(samples)
+	if not tasks:
+		return
+	counts = {"unchanged": unchanged, "linked": 0, "copied": 0}
+	pool = Executors.newFixedThreadPool(IngestThreads)
+	try:
+		for future in pool.invokeAll(tasks):
+			key, record, action = future.get()
+			manifest[key] = record
+			counts[action] += 1
+	finally:
+		pool.shutdown()
+		writeManifest(manifest)
+	print "ingest: %(unchanged)d unchanged, %(linked)d linked, %(copied)d copied" % counts
+
+def scanState():
+	# outputs found in the output directories, for a Processed directory without a state file
+	state = {"current": None, "stage": 0, "samples": {}}
+	masks = os.listdir(MaskDir)
+	others = [os.path.join(d, f) for d in [CompositeDir, ROIDir, StatDir] for f in os.listdir(d)]
+	for SampleDir in os.listdir(TifDir):
+		if SampleDir.startswith("."):
+			continue
+		outputs = {}
+		for f in masks:
+			if '_'.join(f.split("_")[:-1]) in SampleDir:
+				outputs["mask"] = os.path.join(MaskDir, f)
+		sampleinfo = "_".join(SampleDir.split("_")[1:]) # s5 names files without the date
+		for path in others:
+			f = os.path.basename(path)
+			if f == "Composite_" + sampleinfo + ".tif":
+				outputs["composite"] = path
+			elif f == sampleinfo + "_ROI.tif":
+				outputs["roiimage"] = path
+			elif f == sampleinfo + "_ROI.zip":
+				outputs["roi"] = path
+			elif f == SampleDir + "-summary.txt":
+				outputs["summary"] = path
+			elif f.startswith(SampleDir + "_ch") and f.endswith(".csv"):
+				outputs.setdefault("stats", []).append(path)
+		state["samples"][SampleDir] = outputs
+	return state
+
+def sampleState():
+	# the state index, read once (or built from the output directories)
+	global State
+	with StateLock:
+		if State is None:
+			if os.path.exists(StateFile):
+				State = json.load(open(StateFile))
+			else:
+				State = scanState()
+				saveState()
+	return State
+
+def saveState():
+	# called with StateLock held
+	tmppath = StateFile + ".tmp"
+	outf = open(tmppath, "w")
+	json.dump(State, outf, indent=1, sort_keys=True)
+	outf.close()
+	replaceFile(tmppath, StateFile)
+
+def addSamples(samples):
+	state = sampleState()
+	with StateLock:
+		new = [s for s in samples if s not in state["samples"]]
+		for s in new:
+			state["samples"][s] = {}
+		if new:
+			saveState()
+
+def markOutputs(sample, **outputs):
+	# record saved output files of a sample
+	state = sampleState()
+	with StateLock:
+		state["samples"].setdefault(sample, {}).update(outputs)
+		saveState()
+
+def setStage(stage, sample=None):
+	# record the last finished step of the open sample; stage 0 closes it
+	state = sampleState()
+	with StateLock:
+		if sample is not None or stage == 0:
+			state["current"] = sample
+		state["stage"] = stage
+		saveState()
+
+def pendingSamples():
+	# samples without a mask, in name order. a mask deleted from MaskDir makes its sample pending again
+	samples = sampleState()["samples"]
+	with StateLock:
+		stale = [s for s in samples if "mask" in samples[s] and not os.path.exists(samples[s]["mask"])]
+		for s in stale:
+			del samples[s]["mask"]
+		if stale:
+			saveState()
+		return [s for s in sorted(samples) if "mask" not in samples[s]]
+
+def nextSample():
+	# the open sample after a restart, otherwise the first pending one
+	state = sampleState()
+	if state["current"] is not None:
+		return state["current"]
+	pending = pendingSamples()
+	if pending:
+		return pending[0]
+	return None
 
 def s1(redo=False): #composite_selection
 	compositeFlag = True
 	if redo:
 		s5(False)
 		return
-	for SampleDir in os.listdir(TifDir):
-		Skip = False
-		SampleDirPath = os.path.join(TifDir, SampleDir)
-		if SampleDir.startswith("."):
-			continue
-		for f in ['_'.join(x.split("_")[:-1]) for x in os.listdir(MaskDir)]:
-			if f in SampleDir:
-				Skip = True
-		if Skip:
-			continue
-		for f in os.listdir(SampleDirPath):
-			if f.endswith("tif"):
-				imagepath = os.path.join(SampleDirPath, f)
-				IJ.open(imagepath)
-		samplename = "_".join(f.split("_")[:-1])
-		print "samplename: ", samplename
-		break
-	try:
-		titles = getWindowTitles()
-	except:
+	SampleDir = nextSample()
+	if SampleDir is None:
 		print "All samples seem to be processed"
 		return
+	SampleDirPath = os.path.join(TifDir, SampleDir)
+	for f in os.listdir(SampleDirPath):
+		if f.endswith("tif"):
+			imagepath = os.path.join(SampleDirPath, f)
+			IJ.open(imagepath)
+	samplename = SampleDir
+	print "samplename: ", samplename
+	titles = getWindowTitles()
 	print titles
 	if len(titles) < 4:
 		print("This image set is not appropriate for this analysis: process is skipped")
@@ -92,6 +363,8 @@ def s1(redo=False): #composite_selection
 		fs.saveAsTiff(maskfilepath)
 		for t in titles:
 			closeWindowWitoutSave(t)
+		markOutputs(SampleDir, mask=maskfilepath)
+		setStage(0)
 		return
 	chTerms = ["ch00", "ch01", "ch02", "ch03"]
 	chImageTitles = []
@@ -108,14 +381,15 @@ def s1(redo=False): #composite_selection
 		"create",
 		"keep", 
 		"ignore"])
-	for f in os.listdir(CompositeDir):
-		if samplename in f:
-			compositeFlag = False
-			compositepath = os.path.join(CompositeDir, f)
+	compositepath = cachePath(compositeKey(SampleDirPath), ".tif")
+	if os.path.exists(compositepath):
+		compositeFlag = False
 	if compositeFlag:
 		IJ.run("Merge Channels...", mergeoption)
 	else:
 		IJ.open(compositepath)
+		IJ.getImage().setTitle("Composite")
+	setStage(1, SampleDir)
 		
 def s2(redo=False, rerun = False): #masking
 	print "s2 called as", redo
@@ -144,11 +418,12 @@ def s2(redo=False, rerun = False): #masking
 			IJ.run("Duplicate...", "title=ch00_COPY2")
 			IJ.selectWindow("ch00_COPY2")
 	
-	IJ.run("Subtract Background...", "rolling=40 disable") 
-	IJ.run("Gaussian Blur...", "sigma=3")
+	IJ.run("Subtract Background...", "rolling=%s disable" % DapiRolling) 
+	IJ.run("Gaussian Blur...", "sigma=%s" % DapiSigma)
 	IJ.run("Add Image...", "image=Mask x=0 y=0 opacity=100 zero")
 	imp = IJ.getImage()		
 	IJ.run("Threshold...");
+	setStage(2)
 
 def s3(redo=False):
 	print "s3 was called as " , redo
@@ -170,11 +445,12 @@ def s3(redo=False):
 	rm = RoiManager().getInstance()
 	rm.reset()
 	rt = ResultsTable()
-	PA = ParticleAnalyzer(8, 0, rt, 500, 2500, 0.1, 1.0)
+	PA = ParticleAnalyzer(8, 0, rt, MinSize, MaxSize, MinCircularity, MaxCircularity)
 	PA.setRoiManager(rm)
 	PA.analyze(imp)
 	IJ.selectWindow("ch00_COPY")
 	IJ.run("From ROI Manager")
+	setStage(3)
 	IJ.selectWindow("Composite")
 	roiArray = rm.getRoisAsArray()
 	rm2.select(len(roiArray)-1)
@@ -186,9 +462,7 @@ def s4(redo=False):
 	channels = ["ch01", "ch02", "ch03"]
 	titles = getWindowTitles()
 	if redo:
-		for t in titles:
-			if "COPY" in t and "ch00" not in t:
-				closeWindowWitoutSave(t)
+		setStage(3)
 		return				
 	rm = RoiManager().getInstance()
 	channelnames = []
@@ -201,47 +475,65 @@ def s4(redo=False):
 					break
 			break
 	sampleinfo = "_".join(info[:-1])
-	IJ.run("Set Measurements...", "area mean min redirect=None decimal=3")
-	savedfiles = []
+	images = []
+	for c in channels:
+		for t in titles:
+			if c in t:
+				images.append(WindowManager.getImage(t))
+				break
+	savedfiles, summaryfilepath = measureSample(sampleinfo, images, channelnames, rm.getRoisAsArray())
+	if sampleState()["current"] is not None:
+		markOutputs(sampleState()["current"], stats=savedfiles, summary=summaryfilepath)
+	setStage(4)
 
-	for t in titles:
-		for c in channels:
-			if c not in t:
-				continue
-			IJ.selectWindow(t)
-			newtitle = "COPY_" + t
-			IJ.run("Duplicate...", "title="+newtitle)
-			IJ.selectWindow(newtitle)
-			IJ.run("Select All")
-			IJ.run("Subtract Background...", "rolling=0.5 disable")
-			IJ.run("From ROI Manager")
-		   	rm.runCommand('Measure')
-		   	IJ.selectWindow("Results")
-		   	statfilename = sampleinfo + "_" + c + ".csv" 
-		   	savefilepath= os.path.join(StatDir, statfilename)
-		   	IJ.saveAs("Results", savefilepath)
-		   	savedfiles.append(savefilepath)
-		   	IJ.run("Close") 
-	
+def subtractBackground(imp, radius):
+	ip = imp.getProcessor().duplicate()
+	BackgroundSubtracter().rollingBallBackground(ip, radius, False, False, False, False, True)
+	return ip
+
+def measureRois(processors, rois, calibration):
+	# (area, mean, min, max) of each ROI in each processor, computed by ImageJ.
+	# setRoi crops ROIs reaching past the image edge, with their masks
+	measurements = Measurements.AREA | Measurements.MEAN | Measurements.MIN_MAX
+	stats = [[] for ip in processors]
+	for roi in rois:
+		for ip, column in zip(processors, stats):
+			ip.setRoi(roi)
+			s = ImageStatistics.getStatistics(ip, measurements, calibration)
+			column.append((s.area, s.mean, s.min, s.max))
+	return stats
+
+def writeMeasurements(path, column):
+	# same layout as the Results table saved by ImageJ with 3 decimals
+	outf = open(path, "w")
+	outf.write(" ,Area,Mean,Min,Max\n")
+	for i in range(len(column)):
+		outf.write("%d,%.3f,%.3f,%.3f,%.3f\n" % ((i + 1,) + tuple(column[i])))
+	outf.close()
+
+def measureSample(sampleinfo, images, channelnames, rois):
+	# measurement of ch01-ch03 after background subtraction: one table per channel and
+	# the summary of means, both written from the measured values. returns their paths
+	processors = [subtractBackground(imp, SignalRolling) for imp in images]
+	stats = measureRois(processors, rois, images[0].getCalibration())
 	results = []
-	for f in savedfiles:
-		for ch, chname in zip(channels, channelnames):
-			if ch in f:
-				column = []
-				inf = open(f)
-				inf.readline()# ignore header
-				column.append("-".join([ch, chname]))
-				for l in inf:
-					column.append(l.split(",")[2])# add mean
-				inf.close()
-				results.append(column)
-	
+	statfilepaths = []
+	for ch, chname, column in zip(["ch01", "ch02", "ch03"], channelnames, stats):
+		statfilepath = os.path.join(StatDir, sampleinfo + "_" + ch + ".csv")
+		writeMeasurements(statfilepath, column)
+		statfilepaths.append(statfilepath)
+		results.append(["-".join([ch, chname])] + ["%.3f" % s[1] for s in column])
+	return statfilepaths, writeSummary(sampleinfo, results)
+
+def writeSummary(sampleinfo, results):
+	# results: one column per channel, "ch-name" followed by the mean of each cell
 	summaryfilename = sampleinfo+"-summary.txt"
 	summaryfilepath = os.path.join(StatDir, summaryfilename)
 	outf = open(summaryfilepath,"w")
 	for d1,d2,d3 in zip(results[0], results[1], results[2]):
 		outf.write("\t".join([d1,d2,d3])+"\n")
 	outf.close()
+	return summaryfilepath
 
 def s5(saveMask=True):
 	titles = []
@@ -283,6 +575,211 @@ def s5(saveMask=True):
 	rm = RoiManager().getInstance()
 	rm.runCommand("Save", ROIfilepath)
 	rm.reset()
+	outputs = {"roiimage": ROIimagefilepath, "composite": compositepath, "roi": ROIfilepath}
+	if saveMask:
+		outputs["mask"] = maskfilepath
+	SampleDir = sampleState()["current"]
+	if SampleDir is not None:
+		markOutputs(SampleDir, **outputs)
+		if os.path.exists(compositepath):
+			storeFile(compositepath, cachePath(compositeKey(os.path.join(TifDir, SampleDir)), ".tif"))
+	setStage(0)
+
+def readBatchSettings():
+	# sample -> (threshold or None for auto, path of the region selection or None)
+	settings = {}
+	if not os.path.exists(BatchSettingsFile):
+		return settings
+	for l in open(BatchSettingsFile):
+		if l.startswith("#") or not l.strip():
+			continue
+		fields = l.rstrip("\n").split("\t") + ["", ""]
+		threshold = None
+		if fields[1] not in ("", "auto"):
+			threshold = float(fields[1])
+		regionpath = None
+		if fields[2]:
+			regionpath = os.path.join(ProcessedDir, fields[2])
+		settings[fields[0]] = (threshold, regionpath)
+	return settings
+
+def channelNames(title):
+	info = title.split("_")
+	for i in range(len(info)):
+		if info[i].startswith("DAPI"):
+			return info[i+1:i+4]
+	return ["", "", ""]
+
+def regionMask(width, height, roi):
+	# 255 inside the region selection (the whole image without one), as "Create Mask"
+	mask = ByteProcessor(width, height)
+	mask.setValue(255)
+	if roi is None:
+		mask.fill()
+	else:
+		mask.fill(roi)
+	return mask
+
+def dapiBackground(dapi):
+	# s2 on the DAPI image: background subtraction and blur
+	ip = subtractBackground(dapi, DapiRolling)
+	ip.blurGaussian(DapiSigma)
+	return ip
+
+def segmentNuclei(ip, mask, threshold):
+	# s3: threshold inside the region, watershed and particle analysis.
+	# returns a hidden RoiManager and the threshold
+	if threshold is None:
+		ip.setAutoThreshold(BatchAutoThreshold + " dark")
+		threshold = ip.getMinThreshold()
+	ip.setThreshold(threshold, ip.maxValue(), ImageProcessor.NO_LUT_UPDATE)
+	binary = ip.createMask()
+	binary.copyBits(mask, 0, 0, Blitter.AND)
+	EDM().toWatershed(binary)
+	binary.setThreshold(255, 255, ImageProcessor.NO_LUT_UPDATE)
+	rm = RoiManager(True)
+	rt = ResultsTable()
+	# the RoiManager of ParticleAnalyzer is static: one analysis at a time across the batch threads
+	with AnalyzerLock:
+		PA = ParticleAnalyzer(ParticleAnalyzer.EXCLUDE_EDGE_PARTICLES | ParticleAnalyzer.ADD_TO_MANAGER, 0, rt, MinSize, MaxSize, MinCircularity, MaxCircularity)
+		PA.setRoiManager(rm)
+		PA.analyze(ImagePlus("binary", binary), binary)
+	return rm, threshold
+
+def processSample(SampleDir, threshold, regionpath):
+	# s1-s5 for one sample with ImagePlus objects instead of windows. a stage output is
+	# taken from the cache when the hashes of its inputs and its parameters are unchanged
+	paths = channelPaths(os.path.join(TifDir, SampleDir))
+	if len(paths) < 4:
+		return SampleDir + ": not a 4 channel image set, skipped"
+	sampleinfo = "_".join(SampleDir.split("_")[1:]) # s5 names its files without the date
+	hashes = dict([(ch, inputHash(paths[ch])) for ch in paths])
+	images = {}
+	def image(ch):
+		if ch not in images:
+			images[ch] = IJ.openImage(paths[ch])
+		return images[ch]
+	outputs = {"roiimage": os.path.join(ROIDir, sampleinfo + "_ROI.tif")
+		, "composite": os.path.join(CompositeDir, "Composite_" + sampleinfo + ".tif")
+		, "roi": os.path.join(ROIDir, sampleinfo + "_ROI.zip")
+		, "mask": os.path.join(MaskDir, sampleinfo + "_Mask.tif")}
+	computed = []
+
+	compositepath = cachePath(compositeKey(os.path.join(TifDir, SampleDir)), ".tif")
+	if not os.path.exists(compositepath):
+		composite = RGBStackMerge.mergeChannels([image("ch02"), image("ch01"), image("ch03"), image("ch00")], True)
+		FileSaver(composite).saveAsTiff(compositepath + ".tmp")
+		replaceFile(compositepath + ".tmp", compositepath)
+		computed.append("composite")
+	exportFile(compositepath, outputs["composite"])
+
+	regionhash = "whole image"
+	if regionpath:
+		regionhash = inputHash(regionpath)
+	maskkey = cacheKey("mask", (), [hashes["ch00"], regionhash])
+	maskpath = cachePath(maskkey, ".tif")
+	if not os.path.exists(maskpath):
+		region = None
+		if regionpath:
+			region = RoiDecoder(regionpath).getRoi()
+		mask = regionMask(image("ch00").getWidth(), image("ch00").getHeight(), region)
+		FileSaver(ImagePlus("Mask", mask)).saveAsTiff(maskpath + ".tmp")
+		replaceFile(maskpath + ".tmp", maskpath)
+		computed.append("mask")
+
+	dapikey = cacheKey("dapi", (DapiRolling, DapiSigma), [hashes["ch00"]])
+	dapipath = cachePath(dapikey, ".tif")
+	if not os.path.exists(dapipath):
+		FileSaver(ImagePlus("DAPI", dapiBackground(image("ch00")))).saveAsTiff(dapipath + ".tmp")
+		replaceFile(dapipath + ".tmp", dapipath)
+		computed.append("dapi")
+
+	method = threshold
+	if threshold is None:
+		method = BatchAutoThreshold
+	roikey = cacheKey("rois", (method, MinSize, MaxSize, MinCircularity, MaxCircularity), [dapikey, maskkey])
+	roipath = cachePath(roikey, ".zip")
+	thresholdpath = cachePath(roikey, ".txt") # the threshold used, for auto thresholds
+	if not os.path.exists(roipath):
+		mask = IJ.openImage(maskpath).getProcessor()
+		rm, threshold = segmentNuclei(IJ.openImage(dapipath).getProcessor(), mask, threshold)
+		outf = open(thresholdpath, "w")
+		outf.write(str(threshold))
+		outf.close()
+		tmppath = roipath[:-len(".zip")] + ".tmp.zip" # RoiManager saves a ROI set only as .zip
+		if rm.getCount() > 0:
+			rm.runCommand("Save", tmppath)
+		else:
+			zipfile.ZipFile(tmppath, "w").close()
+		replaceFile(tmppath, roipath)
+		computed.append("rois")
+	else:
+		rm = RoiManager(True)
+		rm.runCommand("Open", roipath)
+		threshold = open(thresholdpath).read()
+	rois = rm.getRoisAsArray()
+	exportFile(roipath, outputs["roi"])
+
+	statskey = cacheKey("stats", (SignalRolling,), [roikey, hashes["ch01"], hashes["ch02"], hashes["ch03"]])
+	channelnames = channelNames(os.path.basename(paths["ch03"]))
+	cachedstats = [cachePath(statskey, "_" + ch + ".csv") for ch in ["ch01", "ch02", "ch03"]]
+	cachedstats.append(cachePath(statskey, "-summary.txt"))
+	if [p for p in cachedstats if not os.path.exists(p)]:
+		statfilepaths, summaryfilepath = measureSample(SampleDir, [image(ch) for ch in ["ch01", "ch02", "ch03"]], channelnames, rois)
+		for path, cachedpath in zip(statfilepaths + [summaryfilepath], cachedstats):
+			storeFile(path, cachedpath)
+		computed.append("stats")
+	else:
+		statfilepaths = [os.path.join(StatDir, SampleDir + "_" + ch + ".csv") for ch in ["ch01", "ch02", "ch03"]]
+		summaryfilepath = os.path.join(StatDir, SampleDir + "-summary.txt")
+		for cachedpath, path in zip(cachedstats, statfilepaths + [summaryfilepath]):
+			exportFile(cachedpath, path)
+	outputs["stats"] = statfilepaths
+	outputs["summary"] = summaryfilepath
+
+	roiimage = image("ch00").duplicate()
+	overlay = Overlay()
+	for roi in rois:
+		overlay.add(roi)
+	roiimage.setOverlay(overlay)
+	FileSaver(roiimage).saveAsTiff(outputs["roiimage"])
+	rm.reset()
+	# the mask is saved last: it marks the sample as done
+	exportFile(maskpath, outputs["mask"])
+	markOutputs(SampleDir, **outputs)
+	return "%s: threshold %s, %d cells, computed: %s" % (SampleDir, threshold, len(rois), ", ".join(computed) or "none")
+
+class SampleTask(Callable):
+	def __init__(self, SampleDir, threshold, regionpath):
+		self.SampleDir = SampleDir
+		self.threshold = threshold
+		self.regionpath = regionpath
+
+	def call(self):
+		try:
+			return processSample(self.SampleDir, self.threshold, self.regionpath)
+		except (Exception, Throwable), e:
+			return "%s: failed (%s)" % (self.SampleDir, e)
+
+def batch(threads=BatchThreads):
+	# all samples without a mask (all samples with BatchRedo), processed concurrently
+	settings = readBatchSettings()
+	tasks = []
+	samples = pendingSamples()
+	if BatchRedo:
+		samples = sorted(sampleState()["samples"])
+	for SampleDir in samples:
+		if SampleDir == sampleState()["current"]: # open in the controller
+			continue
+		threshold, regionpath = settings.get(SampleDir, (None, None))
+		tasks.append(SampleTask(SampleDir, threshold, regionpath))
+	print "batch: %d samples on %d threads" % (len(tasks), threads)
+	pool = Executors.newFixedThreadPool(threads)
+	try:
+		for future in pool.invokeAll(tasks):
+			print future.get()
+	finally:
+		pool.shutdown()
 
 def goforward():
 	status = checkStatus()
@@ -297,6 +794,8 @@ def goback():
 	action[status](redo=True)
 
 def checkStatus():
+	# step reached with the open sample; 0 without open images, also after a restart,
+	# so that s1 reopens the sample that was open
 	try:
 		titles = getWindowTitles()
 	except:
@@ -304,14 +803,7 @@ def checkStatus():
 	print "# of opened widonw:",len(titles)
 	if len(titles) == 0:
 		return 0
-	elif len(titles) == 5:
-		return 1
-	elif len(titles) == 8:
-		return 2
-	elif len(titles) == 9:
-		return 3
-	elif len(titles) == 12:
-		return 4
+	return sampleState()["stage"]
 		
 from ij.gui    import NonBlockingGenericDialog
 from java.awt.event   import ActionListener
@@ -330,12 +822,15 @@ class ButtonClic(ActionListener):
         elif source.label == "Reset":
         	s5(False)
 s0()
-gui = NonBlockingGenericDialog("Controler")
-clicRecorder = ButtonClic()  
-labels = ["Go Forward", "Go Back", "Reset"]
-for l in labels:
-	b=Button(l)
-	b.addActionListener(clicRecorder)
-	gui.add(b)
-gui.setLayout(GridLayout(3,3))
-gui.showDialog()
\ No newline at end of file
+if BatchMode or GraphicsEnvironment.isHeadless():
+	batch()
+else:
+	gui = NonBlockingGenericDialog("Controler")
+	clicRecorder = ButtonClic()  
+	labels = ["Go Forward", "Go Back", "Reset"]
+	for l in labels:
+		b=Button(l)
+		b.addActionListener(clicRecorder)
+		gui.add(b)
+	gui.setLayout(GridLayout(3,3))
+	gui.showDialog()
\ No newline at end of file